@@ -0,0 +1,43 @@
+from django.db import models
+
+
+class CodedChoiceField(models.Field):
+    """
+    A choice field stored as a small integer. Python code, forms, the admin and the API keep working with the
+    string values of `choices`; `codes` maps each value to the integer stored in the database, which keeps rows
+    and indexes small and makes comparisons cheap.
+    """
+    description = "String choice stored as a small integer"
+
+    def __init__(self, *args, codes=None, **kwargs):
+        self.codes = dict(codes or {})
+        self.values = {code: value for value, code in self.codes.items()}
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['codes'] = self.codes
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        return 'PositiveSmallIntegerField'
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return self.values[value]
+
+    def to_python(self, value):
+        if isinstance(value, int):
+            return self.values.get(value, value)
+        return value
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            return self.codes[value]
+        except KeyError:
+            raise ValueError("Field '{}' expected one of {} but got {!r}.".format(
+                self.name, ', '.join(self.codes), value))
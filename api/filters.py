@@ -0,0 +1,102 @@
+import uuid
+from decimal import Decimal, InvalidOperation
+
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+def parse_choice(choices):
+    values = [value for value, _ in choices]
+
+    def parse(value):
+        if value not in values:
+            raise ValueError('Expected one of: {}'.format(', '.join(values)))
+        return value
+    return parse
+
+
+def parse_decimal(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError('A valid number is required')
+
+
+def parse_uuid(value):
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        raise ValueError('A valid UUID is required')
+
+
+def parse_timestamp(value):
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        raise ValueError('A valid ISO 8601 datetime is required')
+    return timestamp
+
+
+class Filter:
+    """
+    A list filter on a query parameter.
+
+    :param lookup: The queryset lookup the parsed value is passed to
+    :param parse: Callable that parses the parameter, raising ValueError if it is invalid
+    :param indexed: Whether an index serves the lookup on its own
+    :param annotations: Annotations the lookup needs
+    """
+
+    def __init__(self, lookup, parse, indexed=True, annotations=None):
+        self.lookup = lookup
+        self.parse = parse
+        self.indexed = indexed
+        self.annotations = annotations or {}
+
+
+class IndexedFilterBackend(BaseFilterBackend):
+    """
+    Filter the list action on the view's `filters`, a dict of query parameter name to Filter. Unknown parameters
+    are rejected. Filters that no index serves are only applied to the rows the indexed filters select, and only
+    if those are at most `max_scan_rows`, since they are checked row by row.
+    """
+    reserved_params = ('limit', 'offset', 'expand', 'format')
+    max_scan_rows = 10000
+
+    def filter_queryset(self, request, queryset, view):
+        filters = getattr(view, 'filters', None)
+        if not filters or getattr(view, 'action', None) != 'list':
+            return queryset
+
+        values = self.parse_params(request, filters)
+        indexed = {filters[name].lookup: value for name, value in values.items() if filters[name].indexed}
+        unindexed = [name for name in values if not filters[name].indexed]
+        if unindexed:
+            self.check_scan(queryset.filter(**indexed), filters, indexed, unindexed)
+
+        for name in values:
+            queryset = queryset.annotate(**filters[name].annotations)
+        return queryset.filter(**{filters[name].lookup: value for name, value in values.items()})
+
+    def parse_params(self, request, filters):
+        unknown = set(request.query_params) - set(filters) - set(self.reserved_params)
+        if unknown:
+            raise ValidationError({name: 'Unknown filter' for name in sorted(unknown)})
+
+        values = {}
+        for name, value in request.query_params.items():
+            if name in filters:
+                try:
+                    values[name] = filters[name].parse(value)
+                except ValueError as e:
+                    raise ValidationError({name: str(e)})
+        return values
+
+    def check_scan(self, selected, filters, indexed, unindexed):
+        if not indexed:
+            raise ValidationError({'detail': 'Combine {} with one of: {}'.format(
+                ', '.join(unindexed), ', '.join(name for name, f in filters.items() if f.indexed))})
+        # counting stops after max_scan_rows, so the check itself stays cheap
+        if selected.order_by()[:self.max_scan_rows + 1].count() > self.max_scan_rows:
+            raise ValidationError({'detail': 'Narrow down the other filters to at most {} rows to filter on {}'.format(
+                self.max_scan_rows, ', '.join(unindexed))})
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from api.models import uuid7
+
+GENERATORS = (
+    ('uuid4', uuid.uuid4),
+    ('uuid7', uuid7),
+)
+
+# Same shape as the api_item and api_transaction tables on SQLite
+SCHEMA = (
+    'CREATE TABLE item (id char(32) NOT NULL PRIMARY KEY, amount decimal NOT NULL)',
+    'CREATE TABLE trans (id char(32) NOT NULL PRIMARY KEY, item_id char(32) NOT NULL REFERENCES item (id))',
+    'CREATE INDEX trans_item_id ON trans (item_id)',
+)
+
+
+def index_pages(db):
+    """
+    Return the number of pages used by the indexes, or None if SQLite was built without the dbstat table.
+    """
+    try:
+        return db.execute("SELECT count(*) FROM dbstat WHERE name LIKE 'sqlite_autoindex%' OR name LIKE "
+                          "'trans_item_id'").fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def run(generator, rows, batch_size, cache_pages):
+    """
+    Insert `rows` items, each with two transactions, into a scratch SQLite database.
+
+    :return: tuple of rows inserted per second, index pages and database size in bytes
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.sqlite')
+        db = sqlite3.connect(path)
+        # a small page cache makes the benchmark reflect a table that is much larger than memory
+        db.execute('PRAGMA cache_size = {}'.format(cache_pages))
+        for statement in SCHEMA:
+            db.execute(statement)
+
+        started = time.perf_counter()
+        for offset in range(0, rows, batch_size):
+            items = [(generator().hex, 10) for _ in range(min(batch_size, rows - offset))]
+            transactions = [(generator().hex, item_id) for item_id, _ in items for _ in range(2)]
+            with db:
+                db.executemany('INSERT INTO item VALUES (?, ?)', items)
+                db.executemany('INSERT INTO trans VALUES (?, ?)', transactions)
+        elapsed = time.perf_counter() - started
+
+        pages = index_pages(db)
+        db.close()
+        return rows * 3 / elapsed, pages, os.path.getsize(path)
+
+
+class Command(BaseCommand):
+    help = "Compare insert throughput and index size of random (v4) and time ordered (v7) UUID primary keys"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000, help='Number of items to insert.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Items inserted per transaction.')
+        parser.add_argument('--cache-pages', type=int, default=500, help='SQLite page cache size.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<8}{:>14}{:>14}{:>14}'.format('key', 'rows/s', 'index pages', 'db bytes'))
+        for name, generator in GENERATORS:
+            throughput, pages, size = run(generator, options['rows'], options['batch_size'], options['cache_pages'])
+            self.stdout.write('{:<8}{:>14.0f}{:>14}{:>14}'.format(name, throughput, pages or '-', size))
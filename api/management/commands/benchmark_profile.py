@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Run in a fresh interpreter per settings module, so each one pays its own import and setup cost
+CHILD = '''
+import json
+import sys
+import time
+
+started = time.perf_counter()
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+startup = time.perf_counter() - started
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test.client import RequestFactory
+from api.throttling import SlidingWindowThrottle
+
+call_command('migrate', verbosity=0)
+call_command('createcachetable', verbosity=0)
+settings.ALLOWED_HOSTS = ['localhost']
+SlidingWindowThrottle.THROTTLE_RATES = {'reads': None, 'actions': None, 'actions_global': None}
+
+
+def get(path):
+    # call the WSGI application the way gunicorn does
+    environ = RequestFactory()._base_environ(PATH_INFO=path, REQUEST_METHOD='GET', HTTP_HOST='localhost')
+    statuses = []
+    response = application(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ['200 OK'], statuses
+    b''.join(response)
+    response.close()
+
+
+started = time.perf_counter()
+get('/api/items')
+first_request = time.perf_counter() - started
+
+requests = int(sys.argv[1])
+started = time.perf_counter()
+for _ in range(requests):
+    get('/api/items')
+per_request = (time.perf_counter() - started) / requests
+
+print(json.dumps({'startup': startup, 'first_request': first_request, 'per_request': per_request}))
+'''
+
+
+def measure(settings_module, requests):
+    """
+    Start a new interpreter with `settings_module` against an empty in-memory database and time its startup and
+    requests to the item list.
+
+    :return: dict of startup, first_request and per_request in seconds
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module, HEROKU_POSTGRESQL_URL='sqlite://:memory:')
+    result = subprocess.run([sys.executable, '-c', CHILD, str(requests)], cwd=os.path.dirname(settings.BASE_DIR),
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise CommandError('{} failed:\n{}'.format(settings_module, result.stderr))
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class Command(BaseCommand):
+    help = "Compare the startup time and per request overhead of settings modules"
+
+    def add_arguments(self, parser):
+        parser.add_argument('settings_modules', nargs='*',
+                            default=['routable.settings.production', 'routable.settings.lean'],
+                            help='Settings modules to compare.')
+        parser.add_argument('--requests', type=int, default=1000, help='Requests to time per settings module.')
+        parser.add_argument('--runs', type=int, default=3, help='Runs per settings module, the best is reported.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<32}{:>14}{:>18}{:>16}'.format(
+            'settings', 'startup ms', 'first request ms', 'request us'))
+        for settings_module in options['settings_modules']:
+            runs = [measure(settings_module, options['requests']) for _ in range(options['runs'])]
+            self.stdout.write('{:<32}{:>14.1f}{:>18.1f}{:>16.0f}'.format(
+                settings_module,
+                min(run['startup'] for run in runs) * 1000,
+                min(run['first_request'] for run in runs) * 1000,
+                min(run['per_request'] for run in runs) * 1000000,
+            ))
@@ -0,0 +1,157 @@
+import logging
+import time
+from datetime import timedelta
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils.timezone import now
+from rest_framework.renderers import JSONRenderer
+
+from api.models import EndpointCursor, Event, EventDelivery
+from api.views import EventSerializer
+
+logger = logging.getLogger(__name__)
+
+# how many delivery timeouts a claimed endpoint stays claimed for
+CLAIM_TIMEOUTS = 3
+
+
+def post_events(url, events, timeout):
+    """
+    POST a batch of events to an endpoint. Any response other than a 2xx raises.
+
+    :param url: The endpoint
+    :param events: The events, in order
+    :param timeout: Timeout in seconds
+    :return: None
+    """
+    body = JSONRenderer().render({'events': EventSerializer(events, many=True).data})
+    request = Request(url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        response.read()
+
+
+def delivered_to(endpoint):
+    """
+    :return: Exists expression, true for the events delivered to the endpoint
+    """
+    return Exists(EventDelivery.objects.filter(endpoint=endpoint, event=OuterRef('pk')))
+
+
+def claim_batch(url, config):
+    """
+    Take the next batch of undelivered events for an endpoint, unless it is backing off or another dispatcher
+    holds it. The claim pushes `next_attempt_at` past the time a delivery can take, so the endpoint is released
+    again if this dispatcher dies before recording the outcome.
+
+    :param url: The endpoint
+    :param config: The WEBHOOKS setting
+    :return: tuple of the EndpointCursor and the list of events, which is empty if there is nothing to deliver
+    """
+    EndpointCursor.objects.get_or_create(url=url)
+    with transaction.atomic():
+        # the lock is only held while claiming, so that two dispatchers can't claim the same endpoint
+        cursor = EndpointCursor.objects.select_for_update().get(url=url)
+        if cursor.next_attempt_at and cursor.next_attempt_at > now():
+            return cursor, []
+
+        events = list(Event.objects.filter(~delivered_to(cursor)).order_by('id')[:config['BATCH_SIZE']])
+        if events:
+            cursor.next_attempt_at = now() + timedelta(seconds=config['TIMEOUT'] * CLAIM_TIMEOUTS)
+            cursor.save(update_fields=['next_attempt_at'])
+        return cursor, events
+
+
+def dispatch_endpoint(url, config):
+    """
+    Deliver the next batch of undelivered events to an endpoint, unless it is backing off after a failure. The
+    batch is claimed in one short database transaction, posted outside of any, and recorded in another. The
+    events are only recorded as delivered once the endpoint accepted the whole batch, so every event is delivered
+    at least once. Events go out in id order, except that one committed after a later id was delivered is
+    delivered with the next batch.
+
+    :param url: The endpoint
+    :param config: The WEBHOOKS setting
+    :return: The number of events delivered
+    """
+    cursor, events = claim_batch(url, config)
+    if not events:
+        return 0
+
+    try:
+        post_events(url, events, config['TIMEOUT'])
+    except (URLError, OSError) as e:
+        cursor.attempts += 1
+        backoff = min(config['MAX_BACKOFF'], config['BACKOFF'] * 2 ** (cursor.attempts - 1))
+        cursor.next_attempt_at = now() + timedelta(seconds=backoff)
+        cursor.last_error = str(e)
+        cursor.save()
+        logger.warning("Delivery to %s failed (attempt %d), retrying in %ds: %s", url, cursor.attempts, backoff, e)
+        return 0
+
+    with transaction.atomic():
+        EventDelivery.objects.bulk_create(EventDelivery(endpoint=cursor, event=event) for event in events)
+        cursor.attempts = 0
+        cursor.next_attempt_at = None
+        cursor.last_error = ''
+        cursor.save()
+    return len(events)
+
+
+def prune_events(urls):
+    """
+    Delete the events that every endpoint has received.
+
+    :param urls: The configured endpoints
+    :return: The number of events deleted
+    """
+    cursors = list(EndpointCursor.objects.filter(url__in=urls))
+    if len(cursors) < len(set(urls)):
+        return 0
+    events = Event.objects.all()
+    for cursor in cursors:
+        events = events.filter(delivered_to(cursor))
+    # the deliveries of the events go with them
+    _, counts = events.delete()
+    return counts.get(Event._meta.label, 0)
+
+
+class Command(BaseCommand):
+    help = "Deliver item state change events to the configured webhook endpoints"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Deliver what is pending and exit.')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when there is nothing to deliver.')
+        parser.add_argument('--prune', action='store_true', help='Delete events delivered to every endpoint.')
+        parser.add_argument('--prune-interval', type=float, default=3600.0,
+                            help='Seconds between two prunes of the delivered events.')
+
+    def handle(self, *args, **options):
+        config = settings.WEBHOOKS
+        urls = config['ENDPOINTS']
+        if not urls:
+            self.stdout.write(self.style.WARNING('No webhook endpoints configured'))
+            return
+
+        pruned_at = None
+        while True:
+            delivered = 0
+            while True:
+                batch = sum(dispatch_endpoint(url, config) for url in urls)
+                if not batch:
+                    break
+                delivered += batch
+
+            if delivered:
+                self.stdout.write('Delivered {} events'.format(delivered))
+            if options['prune'] and (pruned_at is None or time.monotonic() - pruned_at >= options['prune_interval']):
+                prune_events(urls)
+                pruned_at = time.monotonic()
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.schema import write_schema
+
+
+class Command(BaseCommand):
+    help = "Render the OpenAPI schema to OPENAPI_SCHEMA_DIR, to be served by the /openapi view"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help='Directory to write to. Defaults to OPENAPI_SCHEMA_DIR.')
+
+    def handle(self, *args, **options):
+        for path in write_schema(options['output'] or settings.OPENAPI_SCHEMA_DIR):
+            self.stdout.write('Wrote {}'.format(path))
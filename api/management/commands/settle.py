@@ -0,0 +1,191 @@
+import multiprocessing
+import os
+import time
+from datetime import timedelta
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from django.utils.timezone import now
+
+from api.models import Event, Item, Transaction
+
+ELIGIBLE_STATES = (Item.STATE_PROCESSING, Item.STATE_CORRECTING)
+
+
+def get_eligible_items():
+    return Item.objects.filter(state__in=ELIGIBLE_STATES).order_by('id')
+
+
+def get_partitions(count):
+    """
+    Split the eligible items into contiguous id ranges of roughly equal size.
+
+    :param count: The number of partitions wanted
+    :return: list of (lower, upper) tuples, lower inclusive and upper exclusive. None means unbounded.
+    """
+    queryset = get_eligible_items().values_list('id', flat=True)
+    total = queryset.count()
+    if not total:
+        return []
+
+    count = max(1, min(count, total))
+    bounds = [None]
+    for index in range(1, count):
+        bounds.append(queryset[total * index // count])
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def advance_items(items):
+    """
+    Walk every item through the automatic transition chain in memory, starting from its active transaction.
+
+    :param items: The items to advance
+    :return: tuple of the new (unsaved) transactions, in the order they were created, and the (unsaved) events of
+        the state changes
+    """
+    active = Transaction.get_active_transactions([item.id for item in items])
+    created = []
+    events = []
+    for item in items:
+        trans = active.get(item.id)
+        if trans is None:
+            continue
+        trans.item = item
+        while True:
+            trans = trans.get_next_transaction_from_state(save_transaction=False)
+            if trans is None:
+                break
+            trans.item = item
+            state = trans.get_item_state()
+            if state and state != item.state:
+                events.append(Event(item=item, transaction=trans, from_state=item.state, to_state=state))
+            if state:
+                item.state = state
+            created.append(trans)
+    return created, events
+
+
+def save_chunk(created, events):
+    """
+    Write the new transactions of a chunk, the state of their items and the events. Must be called inside a
+    database transaction.
+
+    :param created: The new transactions returned by `advance_items`
+    :param events: The events returned by `advance_items`
+    :return: None
+    """
+    # Space the timestamps out so the transactions of an item keep their order under `-updated_at`.
+    stamp = now()
+    for index, trans in enumerate(created):
+        trans.created_at = stamp + timedelta(microseconds=index)
+    Transaction.objects.bulk_create(created)
+
+    # bulk_create applies auto_now, so the spaced timestamps are written back in a second pass
+    for trans in created:
+        trans.updated_at = trans.created_at
+    Transaction.objects.bulk_update(created, ['updated_at'])
+
+    items = list({trans.item_id: trans.item for trans in created}.values())
+    for item in items:
+        item.updated_at = stamp
+    Item.objects.bulk_update(items, ['state', 'updated_at'])
+    Event.objects.bulk_create(events)
+
+
+def settle_partition(lower, upper, chunk_size, dry_run=False):
+    """
+    Advance the eligible items with an id in [lower, upper), one chunk per database transaction. Each chunk
+    re-reads and (unless it is a dry run) locks its items and starts from their latest saved transaction, so re-running after a crash
+    picks up where the last committed chunk left off.
+
+    :param lower: The inclusive lower id bound, or None
+    :param upper: The exclusive upper id bound, or None
+    :param chunk_size: The number of items per chunk
+    :param dry_run: Compute the transitions without writing them
+    :return: dict of counters
+    """
+    stats = {'items': 0, 'transactions': 0, 'resolved': 0}
+    last_id = None
+    while True:
+        with transaction.atomic():
+            queryset = get_eligible_items()
+            if last_id is not None:
+                queryset = queryset.filter(id__gt=last_id)
+            elif lower is not None:
+                queryset = queryset.filter(id__gte=lower)
+            if upper is not None:
+                queryset = queryset.filter(id__lt=upper)
+
+            # a dry run writes nothing, so it has no reason to block the items' writers
+            if not dry_run:
+                queryset = queryset.select_for_update()
+            items = list(queryset[:chunk_size])
+            if not items:
+                break
+
+            created, events = advance_items(items)
+            if created and not dry_run:
+                save_chunk(created, events)
+
+        last_id = items[-1].id
+        stats['items'] += len(items)
+        stats['transactions'] += len(created)
+        stats['resolved'] += sum(1 for item in items if item.state == Item.STATE_RESOLVED)
+    return stats
+
+
+def init_worker():
+    django.setup()
+
+
+def run_partition(args):
+    return settle_partition(*args)
+
+
+class Command(BaseCommand):
+    help = "Advance every processing or correcting item through its automatic transitions until it is resolved"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Number of worker processes. 1 runs in this process.')
+        parser.add_argument('--partitions', type=int, default=None,
+                            help='Number of id ranges to split the items into. Defaults to 4 per process.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of items written per database transaction.')
+        parser.add_argument('--dry-run', action='store_true', help='Compute the transitions without saving them.')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'] or 1)
+        if processes > 1 and connection.vendor == 'sqlite':
+            # SQLite allows a single writer, so parallel workers would only fail each other's transactions
+            self.stdout.write(self.style.WARNING('SQLite does not support concurrent writers, using 1 process'))
+            processes = 1
+        partitions = get_partitions(options['partitions'] or processes * 4)
+        tasks = [(lower, upper, options['chunk_size'], options['dry_run']) for lower, upper in partitions]
+
+        totals = {'items': 0, 'transactions': 0, 'resolved': 0}
+        started = time.monotonic()
+        for done, stats in enumerate(self.run_tasks(tasks, processes), 1):
+            for key, value in stats.items():
+                totals[key] += value
+            elapsed = time.monotonic() - started
+            self.stdout.write('[{}/{}] {} items, {} transactions, {} resolved ({:.0f} items/s)'.format(
+                done, len(tasks), totals['items'], totals['transactions'], totals['resolved'],
+                totals['items'] / elapsed if elapsed else 0))
+
+        prefix = 'Dry run: ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS('{}settled {} items with {} transactions, {} resolved in {:.2f}s'.format(
+            prefix, totals['items'], totals['transactions'], totals['resolved'], time.monotonic() - started)))
+
+    def run_tasks(self, tasks, processes):
+        if processes == 1 or len(tasks) <= 1:
+            for task in tasks:
+                yield run_partition(task)
+            return
+
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        with multiprocessing.Pool(min(processes, len(tasks)), initializer=init_worker) as pool:
+            yield from pool.imap_unordered(run_partition, tasks)
@@ -0,0 +1,42 @@
+# Generated by Django 3.0.5 on 2026-10-19 04:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EndpointCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(max_length=512, unique=True)),
+                ('last_event_id', models.BigIntegerField(default=0, help_text='The last event delivered to the endpoint')),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Failed attempts since the last delivery')),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=[('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error'), ('refunding', 'Refunding'), ('refunded', 'Refunded'), ('fixing', 'Fixing')], help_text='The status of the transaction', max_length=32),
+        ),
+        migrations.CreateModel(
+            name='Event',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Created at')),
+                ('from_state', models.CharField(choices=[('processing', 'First time processing'), ('correcting', 'Unfinished correction'), ('error', 'In error'), ('resolved', 'Processing resolved')], max_length=32)),
+                ('to_state', models.CharField(choices=[('processing', 'First time processing'), ('correcting', 'Unfinished correction'), ('error', 'In error'), ('resolved', 'Processing resolved')], max_length=32)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.Item')),
+                ('transaction', models.ForeignKey(help_text='The transaction that changed the state', on_delete=django.db.models.deletion.CASCADE, related_name='events', to='api.Transaction')),
+            ],
+        ),
+    ]
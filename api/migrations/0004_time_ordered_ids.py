@@ -0,0 +1,24 @@
+# Generated by Django 3.0.5 on 2026-10-19 04:28
+
+import api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_changes_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='item',
+            name='id',
+            field=models.UUIDField(default=api.models.generate_id, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='id',
+            field=models.UUIDField(default=api.models.generate_id, editable=False, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.0.5 on 2026-10-19 04:29
+
+from django.db import migrations, models
+
+import api.fields
+
+STATE_CHOICES = [('processing', 'First time processing'), ('correcting', 'Unfinished correction'), ('error', 'In error'), ('resolved', 'Processing resolved')]
+STATE_CODES = {'processing': 1, 'correcting': 2, 'error': 3, 'resolved': 4}
+STATUS_CHOICES = [('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error'), ('refunding', 'Refunding'), ('refunded', 'Refunded'), ('fixing', 'Fixing')]
+STATUS_CODES = {'processing': 1, 'completed': 2, 'error': 3, 'refunding': 4, 'refunded': 5, 'fixing': 6}
+LOCATION_CHOICES = [('origination_bank', 'Origination Bank'), ('routable', 'Routable'), ('destination_bank', 'Destination Bank')]
+LOCATION_CODES = {'origination_bank': 1, 'routable': 2, 'destination_bank': 3}
+
+
+class Migration(migrations.Migration):
+    """
+    First of three migrations moving the choice columns to integer codes: add the code columns. The next one
+    fills them in batches, and the last one swaps them in for the old columns.
+    """
+
+    dependencies = [
+        ('api', '0004_time_ordered_ids'),
+    ]
+
+    operations = [
+        # the old columns become nullable, so that unapplying the swap can add them back empty for decoding
+        migrations.AlterField(
+            model_name='item',
+            name='state',
+            field=models.CharField(choices=STATE_CHOICES, default='processing', help_text='The state of the payment', max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=models.CharField(choices=STATUS_CHOICES, help_text='The status of the transaction', max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='location',
+            field=models.CharField(choices=LOCATION_CHOICES, help_text='The location of the transaction', max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='from_state',
+            field=models.CharField(choices=STATE_CHOICES, max_length=32, null=True),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='to_state',
+            field=models.CharField(choices=STATE_CHOICES, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='state_code',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status_code',
+            field=api.fields.CodedChoiceField(choices=STATUS_CHOICES, codes=STATUS_CODES, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='location_code',
+            field=api.fields.CodedChoiceField(choices=LOCATION_CHOICES, codes=LOCATION_CODES, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='from_state_code',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES, null=True),
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='to_state_code',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES, null=True),
+        ),
+    ]
@@ -0,0 +1,75 @@
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 1000
+
+STATE_CODES = {'processing': 1, 'correcting': 2, 'error': 3, 'resolved': 4}
+STATUS_CODES = {'processing': 1, 'completed': 2, 'error': 3, 'refunding': 4, 'refunded': 5, 'fixing': 6}
+LOCATION_CODES = {'origination_bank': 1, 'routable': 2, 'destination_bank': 3}
+
+# model name -> (field name, codes) of the columns moved to integer codes
+CODED_FIELDS = {
+    'item': [('state', STATE_CODES)],
+    'transaction': [('status', STATUS_CODES), ('location', LOCATION_CODES)],
+    'event': [('from_state', STATE_CODES), ('to_state', STATE_CODES)],
+}
+
+
+def encode_updates(fields):
+    return {
+        '{}_code'.format(name): models.Case(
+            *[models.When(**{name: value}, then=models.Value(code)) for value, code in codes.items()],
+            output_field=models.PositiveSmallIntegerField())
+        for name, codes in fields
+    }
+
+
+def decode_updates(fields):
+    return {
+        name: models.Case(
+            *[models.When(**{'{}_code'.format(name): value}, then=models.Value(value)) for value in codes],
+            output_field=models.CharField())
+        for name, codes in fields
+    }
+
+
+def update_in_batches(queryset, updates):
+    """
+    Update the rows of the queryset BATCH_SIZE at a time, committing each batch, so that the rows of a batch
+    are only locked until it commits. The migration is not atomic for this reason.
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last = None
+    while True:
+        batch = list((pks if last is None else pks.filter(pk__gt=last))[:BATCH_SIZE])
+        if not batch:
+            return
+        with transaction.atomic():
+            queryset.model.objects.filter(pk__in=batch).update(**updates)
+        last = batch[-1]
+
+
+def encode(apps, schema_editor):
+    for model_name, fields in CODED_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        update_in_batches(model.objects.all(), encode_updates(fields))
+
+
+def decode(apps, schema_editor):
+    for model_name, fields in CODED_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        update_in_batches(model.objects.all(), decode_updates(fields))
+
+
+class Migration(migrations.Migration):
+    """
+    Fill the code columns from the old ones while the application keeps running.
+    """
+    atomic = False
+
+    dependencies = [
+        ('api', '0005_coded_choices'),
+    ]
+
+    operations = [
+        migrations.RunPython(encode, decode),
+    ]
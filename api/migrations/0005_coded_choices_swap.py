@@ -0,0 +1,84 @@
+from django.db import migrations, models
+
+import api.fields
+
+STATE_CHOICES = [('processing', 'First time processing'), ('correcting', 'Unfinished correction'), ('error', 'In error'), ('resolved', 'Processing resolved')]
+STATE_CODES = {'processing': 1, 'correcting': 2, 'error': 3, 'resolved': 4}
+STATUS_CHOICES = [('processing', 'Processing'), ('completed', 'Completed'), ('error', 'Error'), ('refunding', 'Refunding'), ('refunded', 'Refunded'), ('fixing', 'Fixing')]
+STATUS_CODES = {'processing': 1, 'completed': 2, 'error': 3, 'refunding': 4, 'refunded': 5, 'fixing': 6}
+LOCATION_CHOICES = [('origination_bank', 'Origination Bank'), ('routable', 'Routable'), ('destination_bank', 'Destination Bank')]
+LOCATION_CODES = {'origination_bank': 1, 'routable': 2, 'destination_bank': 3}
+
+# model name -> (field name, codes) of the columns moved to integer codes
+CODED_FIELDS = {
+    'item': [('state', STATE_CODES)],
+    'transaction': [('status', STATUS_CODES), ('location', LOCATION_CODES)],
+    'event': [('from_state', STATE_CODES), ('to_state', STATE_CODES)],
+}
+
+
+def encode_stale(apps, schema_editor):
+    """
+    Encode the rows written since the previous migration filled the code columns: the new ones, and the ones
+    whose old column was changed since, which still hold the code of the old value.
+    """
+    for model_name, fields in CODED_FIELDS.items():
+        model = apps.get_model('api', model_name)
+        for name, codes in fields:
+            code_name = '{}_code'.format(name)
+            encoded = models.Case(
+                *[models.When(**{name: value}, then=models.Value(code)) for value, code in codes.items()],
+                output_field=models.PositiveSmallIntegerField())
+            stale = model.objects.annotate(encoded=encoded).filter(
+                models.Q(**{'{}__isnull'.format(code_name): True}) | ~models.Q(**{code_name: models.F('encoded')}))
+            model.objects.filter(pk__in=stale.values('pk')).update(**{code_name: encoded})
+
+
+class Migration(migrations.Migration):
+    """
+    Swap the code columns in for the old ones. Unapplying it leaves the old columns empty, for the previous
+    migration to decode in batches.
+    """
+
+    dependencies = [
+        ('api', '0005_coded_choices_encode'),
+    ]
+
+    operations = [
+        migrations.RunPython(encode_stale, migrations.RunPython.noop),
+        migrations.RemoveField(model_name='item', name='state'),
+        migrations.RemoveField(model_name='transaction', name='status'),
+        migrations.RemoveField(model_name='transaction', name='location'),
+        migrations.RemoveField(model_name='event', name='from_state'),
+        migrations.RemoveField(model_name='event', name='to_state'),
+        migrations.RenameField(model_name='item', old_name='state_code', new_name='state'),
+        migrations.RenameField(model_name='transaction', old_name='status_code', new_name='status'),
+        migrations.RenameField(model_name='transaction', old_name='location_code', new_name='location'),
+        migrations.RenameField(model_name='event', old_name='from_state_code', new_name='from_state'),
+        migrations.RenameField(model_name='event', old_name='to_state_code', new_name='to_state'),
+        migrations.AlterField(
+            model_name='item',
+            name='state',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES, default='processing', help_text='The state of the payment'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=api.fields.CodedChoiceField(choices=STATUS_CHOICES, codes=STATUS_CODES, help_text='The status of the transaction'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='location',
+            field=api.fields.CodedChoiceField(choices=LOCATION_CHOICES, codes=LOCATION_CODES, help_text='The location of the transaction'),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='from_state',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES),
+        ),
+        migrations.AlterField(
+            model_name='event',
+            name='to_state',
+            field=api.fields.CodedChoiceField(choices=STATE_CHOICES, codes=STATE_CODES),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.5 on 2026-10-19 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_coded_choices_swap'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['state', 'updated_at'], name='api_item_state'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['amount'], name='api_item_amount'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['created_at'], name='api_item_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['item', 'updated_at'], name='api_transaction_item'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'location'], name='api_transaction_status'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['created_at'], name='api_transaction_created_at'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def deliveries_from_cursors(apps, schema_editor):
+    """
+    Record the events below each endpoint's last delivered id as delivered
+    """
+    EndpointCursor = apps.get_model('api', 'EndpointCursor')
+    Event = apps.get_model('api', 'Event')
+    EventDelivery = apps.get_model('api', 'EventDelivery')
+    for cursor in EndpointCursor.objects.all():
+        event_ids = Event.objects.filter(id__lte=cursor.last_event_id).values_list('id', flat=True).iterator()
+        EventDelivery.objects.bulk_create((EventDelivery(endpoint=cursor, event_id=event_id) for event_id in event_ids),
+                                          batch_size=1000)
+
+
+def cursors_from_deliveries(apps, schema_editor):
+    EndpointCursor = apps.get_model('api', 'EndpointCursor')
+    for cursor in EndpointCursor.objects.annotate(last=models.Max('deliveries__event_id')):
+        cursor.last_event_id = cursor.last or 0
+        cursor.save(update_fields=['last_event_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EventDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delivered_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Delivered at')),
+                ('endpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='api.EndpointCursor')),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='api.Event')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='eventdelivery',
+            constraint=models.UniqueConstraint(fields=('endpoint', 'event'), name='api_eventdelivery_unique'),
+        ),
+        migrations.RunPython(deliveries_from_cursors, cursors_from_deliveries),
+        migrations.RemoveField(
+            model_name='endpointcursor',
+            name='last_event_id',
+        ),
+    ]
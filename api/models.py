@@ -1,17 +1,49 @@
+import os
+import time
 import uuid
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
 from django.utils.timezone import now
 
+from api.fields import CodedChoiceField
+
+
+def uuid7():
+    """
+    Return a time ordered UUID (version 7): a 48 bit millisecond timestamp followed by random bits, so new keys
+    are appended at the right edge of the primary key index instead of being spread across it.
+    """
+    value = (int(time.time() * 1000) & 0xFFFFFFFFFFFF) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xF << 76) | 0x7 << 76  # version 7
+    value = value & ~(0x3 << 62) | 0x2 << 62  # RFC 4122 variant
+    return uuid.UUID(int=value)
+
+
+def generate_id():
+    """
+    Return a new primary key: time ordered if the `TIME_ORDERED_IDS` setting is on, random otherwise.
+    """
+    if settings.TIME_ORDERED_IDS:
+        return uuid7()
+    return uuid.uuid4()
+
 
 class BaseModel(models.Model):
     """
-    Base model that adds an id in UUID form, and a created and updated timestamp on the model
+    Base model that adds an id in UUID form, and a created and updated timestamp on the model. Ids created before
+    `TIME_ORDERED_IDS` was turned on stay random UUIDs, both kinds are valid keys.
     """
     class Meta:
         abstract = True
+        indexes = [
+            # keyset access path of the change feed
+            models.Index(fields=['updated_at', 'id'], name='%(app_label)s_%(class)s_changes'),
+        ]
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=generate_id, editable=False)
     created_at = models.DateTimeField('Created at', default=now)
     updated_at = models.DateTimeField('Updated At', auto_now=True)
 
@@ -28,6 +60,13 @@ class Item(BaseModel):
     """
     Store a payment
     """
+    class Meta(BaseModel.Meta):
+        indexes = BaseModel.Meta.indexes + [
+            models.Index(fields=['state', 'updated_at'], name='api_item_state'),
+            models.Index(fields=['amount'], name='api_item_amount'),
+            models.Index(fields=['created_at'], name='api_item_created_at'),
+        ]
+
     STATE_PROCESSING = "processing"
     STATE_CORRECTING = "correcting"
     STATE_ERROR = "error"
@@ -40,8 +79,16 @@ class Item(BaseModel):
         (STATE_RESOLVED, "Processing resolved"),
     )
 
+    # Stored values of the states. Never reuse or renumber a code.
+    STATE_CODES = {
+        STATE_PROCESSING: 1,
+        STATE_CORRECTING: 2,
+        STATE_ERROR: 3,
+        STATE_RESOLVED: 4,
+    }
+
     amount = models.DecimalField(max_digits=8, decimal_places=2)
-    state = models.CharField(default=STATE_PROCESSING, max_length=32, choices=STATE_CHOICES,
+    state = CodedChoiceField(default=STATE_PROCESSING, choices=STATE_CHOICES, codes=STATE_CODES,
                              help_text='The state of the payment')
 
     def refund(self):
@@ -71,6 +118,14 @@ class Transaction(BaseModel):
     """
     Store a transaction of an associated Item (payment)
     """
+    class Meta(BaseModel.Meta):
+        indexes = BaseModel.Meta.indexes + [
+            # access path of an item's active transaction and history
+            models.Index(fields=['item', 'updated_at'], name='api_transaction_item'),
+            models.Index(fields=['status', 'location'], name='api_transaction_status'),
+            models.Index(fields=['created_at'], name='api_transaction_created_at'),
+        ]
+
     STATUS_PROCESSING = 'processing'
     STATUS_COMPLETED = 'completed'
     STATUS_ERROR = 'error'
@@ -87,6 +142,16 @@ class Transaction(BaseModel):
         (STATUS_FIXING, 'Fixing')
     )
 
+    # Stored values of the statuses and locations. Never reuse or renumber a code.
+    STATUS_CODES = {
+        STATUS_PROCESSING: 1,
+        STATUS_COMPLETED: 2,
+        STATUS_ERROR: 3,
+        STATUS_REFUNDING: 4,
+        STATUS_REFUNDED: 5,
+        STATUS_FIXING: 6,
+    }
+
     LOCATION_ORIGIN = "origination_bank"
     LOCATION_ROUTABLE = "routable"
     LOCATION_DESTINATION = "destination_bank"
@@ -97,14 +162,49 @@ class Transaction(BaseModel):
         (LOCATION_DESTINATION, 'Destination Bank')
     )
 
+    LOCATION_CODES = {
+        LOCATION_ORIGIN: 1,
+        LOCATION_ROUTABLE: 2,
+        LOCATION_DESTINATION: 3,
+    }
+
     item = models.ForeignKey(Item, on_delete=models.CASCADE, verbose_name="The transactions payment")
-    status = models.CharField(max_length=32, choices=STATUS_CHOICES, help_text='The status of the transaction')
-    location = models.CharField(max_length=32, choices=LOCATION_CHOICES, help_text='The location of the transaction')
+    status = CodedChoiceField(choices=STATUS_CHOICES, codes=STATUS_CODES, help_text='The status of the transaction')
+    location = CodedChoiceField(choices=LOCATION_CHOICES, codes=LOCATION_CODES,
+                                help_text='The location of the transaction')
 
     @staticmethod
     def get_active_transaction(pk):
         return Transaction.objects.select_related().filter(item__id=pk).order_by('-updated_at')[0]
 
+    @staticmethod
+    def get_latest_transactions(item_ids, count):
+        """
+        Return the latest `count` transactions of each of the given items. The transactions of the items are
+        numbered once with a window function, rather than looked up with a subquery per transaction.
+
+        :param item_ids: The primary keys of the items
+        :param count: The number of transactions per item
+        :return: QuerySet of Transaction
+        """
+        ranked = Transaction.objects.filter(item_id__in=item_ids).order_by().annotate(recency=models.Window(
+            RowNumber(), partition_by=[models.F('item_id')],
+            order_by=[models.F('updated_at').desc(), models.F('id').desc()]))
+        # a window function can't be filtered on directly, so its query becomes a derived table
+        sql, params = ranked.values('id', 'recency').query.sql_with_params()
+        return Transaction.objects.filter(id__in=RawSQL(
+            'SELECT id FROM ({}) ranked WHERE recency <= %s'.format(sql), params + (count,)))
+
+    @staticmethod
+    def get_active_transactions(item_ids):
+        """
+        Return the latest transaction of each of the given items in a single query.
+
+        :param item_ids: The primary keys of the items
+        :return: dict of item id to Transaction
+        """
+        return {trans.item_id: trans for trans in Transaction.get_latest_transactions(item_ids, 1)}
+
     def get_next_transaction_from_state(self, save_transaction=True):
         """
         Return a new transaction in the next automatic state and location. Please note that 'refund',
@@ -134,30 +234,99 @@ class Transaction(BaseModel):
             trans.save()
         return trans
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+    def get_item_state(self):
         """
-        Saves the transaction, but also updates the associated item's state.
+        Return the state the associated item transitions to when this transaction is saved, or None if saving it
+        does not affect the item's state.
 
-        :param force_insert:
-        :param force_update:
-        :param using:
-        :param update_fields:
-        :return:
+        :return: str or None
         """
         # transition item to resolved state
         if self.status in [self.STATUS_COMPLETED, self.STATUS_REFUNDED]:
-            self.item.update_state(Item.STATE_RESOLVED)
+            return Item.STATE_RESOLVED
 
         # transition item to error state
         elif self.status == self.STATUS_ERROR:
-            self.item.update_state(Item.STATE_ERROR)
+            return Item.STATE_ERROR
 
         # transition item from ERROR to CORRECTING
         elif self.status in [self.STATUS_PROCESSING, self.STATUS_REFUNDING, self.STATUS_FIXING] and \
                 self.item.state == Item.STATE_ERROR:
-            self.item.update_state(Item.STATE_CORRECTING)
+            return Item.STATE_CORRECTING
+
+        return None
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        """
+        Saves the transaction, but also updates the associated item's state and records an Event when the state
+        changes.
+
+        :param force_insert:
+        :param force_update:
+        :param using:
+        :param update_fields:
+        :return:
+        """
+        state = self.get_item_state()
+        with transaction.atomic(using=using):
+            previous = self.item.state
+            if state:
+                self.item.update_state(state)
+
+            super().save(force_insert, force_update, using, update_fields)
 
-        super().save(force_insert, force_update, using, update_fields)
+            # record the state change in the outbox, in the same database transaction
+            if state and state != previous:
+                Event.objects.create(item=self.item, transaction=self, from_state=previous, to_state=state)
 
     def __unicode__(self):
         return u'{}: {} status: {}, location: {}'.format(self.id, self.item, self.status, self.location)
+
+
+class Event(models.Model):
+    """
+    Store a change of an Item's state, to be delivered to the webhook endpoints (transactional outbox)
+    """
+    id = models.BigAutoField(primary_key=True)
+    created_at = models.DateTimeField('Created at', default=now)
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='events')
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='events',
+                                    help_text='The transaction that changed the state')
+    from_state = CodedChoiceField(choices=Item.STATE_CHOICES, codes=Item.STATE_CODES)
+    to_state = CodedChoiceField(choices=Item.STATE_CHOICES, codes=Item.STATE_CODES)
+
+    def __unicode__(self):
+        return u'{}: {} {} -> {}'.format(self.id, self.item_id, self.from_state, self.to_state)
+
+
+class EndpointCursor(models.Model):
+    """
+    Track the delivery of events to a webhook endpoint
+    """
+    url = models.URLField(max_length=512, unique=True)
+    attempts = models.PositiveIntegerField(default=0, help_text='Failed attempts since the last delivery')
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'{}: {} attempts'.format(self.url, self.attempts)
+
+
+class EventDelivery(models.Model):
+    """
+    Record that an event was delivered to an endpoint. Deliveries are tracked per event rather than with the
+    highest id delivered, because event ids are allocated on insert but become visible on commit, which
+    concurrent transactions do out of order.
+    """
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['endpoint', 'event'], name='api_eventdelivery_unique'),
+        ]
+
+    endpoint = models.ForeignKey(EndpointCursor, on_delete=models.CASCADE, related_name='deliveries')
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, related_name='deliveries')
+    delivered_at = models.DateTimeField('Delivered at', default=now)
+
+    def __unicode__(self):
+        return u'{}: {}'.format(self.endpoint_id, self.event_id)
+
@@ -0,0 +1,22 @@
+from rest_framework.pagination import LimitOffsetPagination
+
+
+class BoundedLimitOffsetPagination(LimitOffsetPagination):
+    """
+    Limit/offset pagination that only applies when the client passes `limit`, so existing clients keep getting
+    a plain list. The page size is capped at `max_limit`.
+    """
+    max_limit = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # skip the count query when the list is not paginated
+        if self.get_limit(request) is None:
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class HistoryPagination(BoundedLimitOffsetPagination):
+    """
+    Always paginate, for lists that are too long to return whole.
+    """
+    default_limit = 50
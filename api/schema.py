@@ -0,0 +1,161 @@
+import gzip
+import hashlib
+import os
+
+import django
+import rest_framework
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
+from django.views import View
+from rest_framework.renderers import JSONOpenAPIRenderer, OpenAPIRenderer
+from rest_framework.schemas.openapi import SchemaGenerator
+
+from routable.compression import accepted_encodings
+
+SCHEMA_OPTIONS = {
+    'title': "Routable API",
+    'description': "API for Routable take home project",
+    'urlconf': 'api.urls',
+    'version': "1.0.0",
+}
+
+# format name -> (file name, renderer)
+FORMATS = {
+    'openapi': ('openapi.yaml', OpenAPIRenderer),
+    'openapi-json': ('openapi.json', JSONOpenAPIRenderer),
+}
+
+# written next to the schema files, see schema_fingerprint
+FINGERPRINT_FILE = 'fingerprint'
+
+
+class SchemaDocument:
+    """
+    A rendered schema, with its gzipped form and the ETag of each computed once.
+    """
+
+    def __init__(self, content, media_type):
+        self.content = content
+        self.media_type = media_type
+        self.gzipped = gzip.compress(content, mtime=0)
+        self.etag = quote_etag(hashlib.md5(content).hexdigest())
+        self.gzipped_etag = quote_etag(hashlib.md5(self.gzipped).hexdigest())
+
+
+def render_schema():
+    """
+    Generate the schema of the API and render it in every format.
+
+    :return: dict of format name to rendered bytes
+    """
+    schema = SchemaGenerator(**SCHEMA_OPTIONS).get_schema(request=None, public=True)
+    return {name: renderer().render(schema, renderer_context={}) for name, (_, renderer) in FORMATS.items()}
+
+
+def schema_fingerprint():
+    """
+    Hash what the schema is generated from: the source of the api app, the Django and DRF versions and the
+    settings involved. Schema files written with a different fingerprint are stale.
+
+    :return: str
+    """
+    digest = hashlib.md5()
+    app_directory = os.path.dirname(os.path.abspath(__file__))
+    for root, directories, files in os.walk(app_directory):
+        directories[:] = sorted(name for name in directories if name not in ('__pycache__', 'migrations'))
+        for name in sorted(name for name in files if name.endswith('.py')):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, app_directory).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    digest.update(repr((django.__version__, rest_framework.VERSION, settings.REST_FRAMEWORK, SCHEMA_OPTIONS)).encode())
+    return digest.hexdigest()
+
+
+def write_schema(directory):
+    """
+    Write the rendered schema files, as generated by `manage.py generate_schema`.
+
+    :param directory: The directory to write to
+    :return: list of the paths written
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, content in render_schema().items():
+        path = os.path.join(directory, FORMATS[name][0])
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths.append(path)
+    path = os.path.join(directory, FINGERPRINT_FILE)
+    with open(path, 'w') as f:
+        f.write(schema_fingerprint())
+    paths.append(path)
+    return paths
+
+
+def read_fingerprint(directory):
+    try:
+        with open(os.path.join(directory, FINGERPRINT_FILE)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def load_schema():
+    """
+    Load the schema written at build time from OPENAPI_SCHEMA_DIR, or generate it if it was not, or was written
+    from other code or settings, e.g. left over from an older checkout.
+
+    :return: dict of format name to SchemaDocument
+    """
+    directory = settings.OPENAPI_SCHEMA_DIR
+    paths = {name: os.path.join(directory, file_name) for name, (file_name, _) in FORMATS.items()}
+    if all(os.path.exists(path) for path in paths.values()) and read_fingerprint(directory) == schema_fingerprint():
+        contents = {}
+        for name, path in paths.items():
+            with open(path, 'rb') as f:
+                contents[name] = f.read()
+    else:
+        contents = render_schema()
+    return {name: SchemaDocument(content, FORMATS[name][1].media_type) for name, content in contents.items()}
+
+
+class CachedSchemaView(View):
+    """
+    Serve the OpenAPI schema from memory instead of introspecting every view on each request. Negotiates the
+    format like the DRF schema view (`Accept` or `?format=`), and supports ETags and gzip.
+    """
+    documents = None
+
+    @classmethod
+    def get_documents(cls):
+        if cls.documents is None:
+            cls.documents = load_schema()
+        return cls.documents
+
+    def get_format(self, request):
+        name = request.GET.get('format')
+        if name in FORMATS:
+            return name
+        if JSONOpenAPIRenderer.media_type in request.META.get('HTTP_ACCEPT', ''):
+            return 'openapi-json'
+        return 'openapi'
+
+    def get(self, request, *args, **kwargs):
+        document = self.get_documents()[self.get_format(request)]
+        # the gzipped body is a different representation, so it has an ETag of its own
+        gzipped = 'gzip' in accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = document.gzipped_etag if gzipped else document.etag
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            if gzipped:
+                response = HttpResponse(document.gzipped, content_type=document.media_type)
+                response['Content-Encoding'] = 'gzip'
+            else:
+                response = HttpResponse(document.content, content_type=document.media_type)
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+        patch_cache_control(response, public=True, max_age=300)
+        return response
@@ -1,8 +1,94 @@
+import copy
+import gzip
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TransactionTestCase as DatabaseTransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import include, path, reverse
+from django.utils.timezone import now
 from rest_framework import status as rest_status
+from rest_framework.schemas import get_schema_view
 from rest_framework.test import APITestCase, URLPatternsTestCase
 
-from api.models import Item, Transaction
+from api.filters import IndexedFilterBackend
+from api.management.commands import dispatch_events
+from api.models import EndpointCursor, Event, EventDelivery, Item, Transaction, generate_id, uuid7
+from api.schema import SCHEMA_OPTIONS, CachedSchemaView
+from api.throttling import THROTTLE_CACHE, SlidingWindowThrottle, WriteAdmission
+from routable.compression import accepted_encodings, brotli
+from routable.middleware import CompressionMiddleware
+
+
+def explicit_timestamps():
+    """
+    Let created_at and updated_at be set by hand, instead of to the current time on save.
+    :return: context manager
+    """
+    stack = ExitStack()
+    for model in (Item, Transaction):
+        for name in ('created_at', 'updated_at'):
+            field = model._meta.get_field(name)
+            stack.enter_context(mock.patch.multiple(field, auto_now=False, auto_now_add=False))
+    return stack
+
+
+def create_items(count, history=1, amount=100, started=None):
+    """
+    Create items with their transactions in a few bulk inserts, instead of one `Transaction.save` and
+    `Item.update_state` per transaction. Each item has `history` transactions an hour apart, the latest of which is
+    processing at the origination bank; the earlier ones alternate between error and fixing.
+
+    :param count: Number of items
+    :param history: Number of transactions per item
+    :param amount: Amount of every item
+    :param started: Time of the first transaction, by default far enough back for all of them to be in the past
+    :return: list of the items, oldest first
+    """
+    started = started or now() - timedelta(hours=history, minutes=1)
+    steps = [(Transaction.STATUS_ERROR, Transaction.LOCATION_ROUTABLE),
+             (Transaction.STATUS_FIXING, Transaction.LOCATION_ROUTABLE)]
+
+    items = []
+    transactions = []
+    for index in range(count):
+        # a millisecond apart, so that items and transactions sort the same way every time
+        offset = timedelta(milliseconds=index)
+        latest = started + timedelta(hours=history - 1) + offset
+        item = Item(amount=amount, state=Item.STATE_PROCESSING, created_at=started + offset, updated_at=latest)
+        items.append(item)
+        for position in range(history):
+            if position == history - 1:
+                status, location = Transaction.STATUS_PROCESSING, Transaction.LOCATION_ORIGIN
+            else:
+                status, location = steps[position % len(steps)]
+            stamp = started + timedelta(hours=position) + offset
+            transactions.append(Transaction(item=item, status=status, location=location, created_at=stamp,
+                                            updated_at=stamp))
+
+    with explicit_timestamps():
+        Item.objects.bulk_create(items, batch_size=500)
+        Transaction.objects.bulk_create(transactions, batch_size=500)
+    return items
 
 
 class APIBaseTestCase(APITestCase, URLPatternsTestCase):
@@ -14,10 +100,15 @@ class APIBaseTestCase(APITestCase, URLPatternsTestCase):
         path('api/', include('api.urls')),
     ]
 
+    @classmethod
+    def setUpTestData(cls):
+        cls.amount = 12000.0
+        cls.item = Item.objects.create(amount=cls.amount)
+
     def setUp(self) -> None:
-        self.amount = 12000.0
-        self.item = Item(amount=self.amount)
-        self.item.save()
+        caches[THROTTLE_CACHE].clear()
+        # objects from setUpTestData are shared by the tests of the class, each test changes its own copy
+        self.item = copy.deepcopy(self.item)
 
     def new_transaction(self, status=Transaction.STATUS_PROCESSING, location=Transaction.LOCATION_ORIGIN):
         """
@@ -259,6 +350,23 @@ class TransactionTestCase(APIBaseTestCase):
         self.assertEqual(response.data[0]['status'], Transaction.STATUS_PROCESSING)
         self.assertEqual(response.data[0]['location'], Transaction.LOCATION_ORIGIN)
 
+    def test_transaction_status_stored_as_code(self):
+        trans = self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT status, location FROM api_transaction WHERE id = %s', [Transaction._meta.pk.get_db_prep_value(trans.id, connection)])
+            self.assertEqual(cursor.fetchone(), (3, 2))
+        self.assertEqual(Item.objects.filter(state=Item.STATE_ERROR).get().id, self.item.id)
+
+        response = self.client.get(reverse('transaction-detail', args=[trans.id]), format='json')
+        self.assertEqual(response.data['status'], Transaction.STATUS_ERROR)
+        self.assertEqual(response.data['location'], Transaction.LOCATION_ROUTABLE)
+
+    def test_transaction_create_invalid_status(self):
+        data = {'item': self.item.id, 'status': 'lost', 'location': Transaction.LOCATION_ORIGIN}
+        response = self.client.post(reverse('transaction-list'), data, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+        self.assertIn('status', response.data)
+
     def test_transaction_get(self):
         trans = self.new_transaction()
 
@@ -267,3 +375,857 @@ class TransactionTestCase(APIBaseTestCase):
         self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
         self.assertEqual(response.data['status'], Transaction.STATUS_PROCESSING)
         self.assertEqual(response.data['location'], Transaction.LOCATION_ORIGIN)
+
+
+class SettleCommandTestCase(APIBaseTestCase):
+
+    def settle(self, *args):
+        out = StringIO()
+        call_command('settle', '--processes=1', '--chunk-size=2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_settle_resolves_items(self):
+        self.new_transaction()
+        refunding = Item.objects.create(amount=10, state=Item.STATE_CORRECTING)
+        Transaction(item=refunding, status=Transaction.STATUS_REFUNDING, location=Transaction.LOCATION_ROUTABLE).save()
+        errored = Item.objects.create(amount=20)
+        Transaction(item=errored, status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE).save()
+
+        self.settle()
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.state, Item.STATE_RESOLVED)
+        self.assertEqual(Transaction.objects.filter(item=self.item).count(), 3)
+        self.assertTransaction(self.get_latest_transaction(), Transaction.STATUS_COMPLETED,
+                               Transaction.LOCATION_DESTINATION)
+        self.assertEqual(Event.objects.get(item=self.item).to_state, Item.STATE_RESOLVED)
+
+        refunding.refresh_from_db()
+        self.assertEqual(refunding.state, Item.STATE_RESOLVED)
+        self.assertTransaction(Transaction.get_active_transaction(refunding.id), Transaction.STATUS_REFUNDED,
+                               Transaction.LOCATION_ORIGIN)
+
+        # items in error are left for a user to fix
+        errored.refresh_from_db()
+        self.assertEqual(errored.state, Item.STATE_ERROR)
+        self.assertEqual(Transaction.objects.filter(item=errored).count(), 1)
+
+    def test_settle_is_restartable(self):
+        self.new_transaction()
+        self.settle()
+        self.settle()
+        self.assertEqual(Transaction.objects.filter(item=self.item).count(), 3)
+
+    def test_settle_dry_run(self):
+        self.new_transaction()
+        with mock.patch.object(QuerySet, 'select_for_update', side_effect=AssertionError('dry run locked items')):
+            output = self.settle('--dry-run')
+        self.assertIn('Dry run: settled 1 items with 2 transactions, 1 resolved', output)
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.state, Item.STATE_PROCESSING)
+        self.assertEqual(Transaction.objects.filter(item=self.item).count(), 1)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Local stand-in for a webhook endpoint, recording the batches it receives"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.batches.append(json.loads(body.decode()))
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookTestCase(APIBaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), WebhookHandler)
+        threading.Thread(target=cls.server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True).start()
+        cls.url = 'http://127.0.0.1:{}/hook'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.server.batches = []
+        self.server.status = 200
+
+        config = {'ENDPOINTS': [self.url], 'BATCH_SIZE': 2, 'TIMEOUT': 5, 'BACKOFF': 60, 'MAX_BACKOFF': 300}
+        settings_override = override_settings(WEBHOOKS=config)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def dispatch(self, *args):
+        call_command('dispatch_events', '--once', *args, stdout=StringIO())
+
+    def new_event(self, event_id, trans):
+        return Event.objects.create(id=event_id, item=self.item, transaction=trans, from_state=Item.STATE_PROCESSING,
+                                    to_state=Item.STATE_ERROR)
+
+    def test_event_on_state_change(self):
+        self.new_transaction()
+        self.assertEqual(Event.objects.count(), 0)
+
+        self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        event = Event.objects.get()
+        self.assertEqual(event.item_id, self.item.id)
+        self.assertEqual(event.from_state, Item.STATE_PROCESSING)
+        self.assertEqual(event.to_state, Item.STATE_ERROR)
+
+    def test_dispatch_in_order(self):
+        self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        self.item.fix()
+        self.new_transaction(status=Transaction.STATUS_COMPLETED, location=Transaction.LOCATION_DESTINATION)
+
+        self.dispatch()
+
+        self.assertEqual([len(batch['events']) for batch in self.server.batches], [2, 1])
+        states = [event['to_state'] for batch in self.server.batches for event in batch['events']]
+        self.assertEqual(states, [Item.STATE_ERROR, Item.STATE_CORRECTING, Item.STATE_RESOLVED])
+        self.assertEqual(EventDelivery.objects.filter(endpoint__url=self.url).count(), 3)
+
+        # nothing left to deliver
+        self.dispatch()
+        self.assertEqual(len(self.server.batches), 2)
+
+    def test_dispatch_failure_backs_off(self):
+        self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        self.server.status = 500
+
+        with self.assertLogs('api', 'WARNING'):
+            self.dispatch()
+        cursor = EndpointCursor.objects.get(url=self.url)
+        self.assertFalse(cursor.deliveries.exists())
+        self.assertEqual(cursor.attempts, 1)
+        self.assertIsNotNone(cursor.next_attempt_at)
+
+        # still backing off, so the endpoint is not called again
+        self.server.status = 200
+        self.dispatch()
+        self.assertEqual(len(self.server.batches), 1)
+
+    def test_dispatch_posts_outside_transaction(self):
+        self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        config = settings.WEBHOOKS
+        savepoints = list(connection.savepoint_ids)
+        post_events = dispatch_events.post_events
+
+        def post_claimed(*args):
+            self.assertEqual(connection.savepoint_ids, savepoints)
+            # the endpoint is claimed, so a second dispatcher leaves it alone
+            self.assertEqual(dispatch_events.dispatch_endpoint(self.url, config), 0)
+            post_events(*args)
+
+        with mock.patch.object(dispatch_events, 'post_events', side_effect=post_claimed):
+            self.assertEqual(dispatch_events.dispatch_endpoint(self.url, config), 1)
+        self.assertEqual(len(self.server.batches), 1)
+        self.assertIsNone(EndpointCursor.objects.get(url=self.url).next_attempt_at)
+
+    def test_dispatch_event_committed_out_of_order(self):
+        trans = self.new_transaction()
+        # event 11 commits while event 10 is still in an open transaction
+        self.new_event(11, trans)
+        self.dispatch('--prune')
+        self.assertFalse(Event.objects.exists())
+
+        self.new_event(10, trans)
+        self.dispatch('--prune')
+        ids = [[event['id'] for event in batch['events']] for batch in self.server.batches]
+        self.assertEqual(ids, [[11], [10]])
+
+
+class ChangeFeedTestCase(APIBaseTestCase):
+
+    def get_changes(self, **params):
+        response = self.client.get(reverse('changes'), params, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        return response.data
+
+    def test_changes(self):
+        trans = self.new_transaction()
+        data = self.get_changes()
+        self.assertEqual([(change['type'], change['data']['id']) for change in data['results']],
+                         [('item', str(self.item.id)), ('transaction', str(trans.id))])
+        self.assertFalse(data['has_more'])
+
+        # nothing changed since the cursor
+        data = self.get_changes(since=data['cursor'])
+        self.assertEqual(data['results'], [])
+
+        self.call_move_endpoint()
+        self.call_error_endpoint()
+        data = self.get_changes(since=data['cursor'])
+        self.assertEqual([change['type'] for change in data['results']], ['transaction', 'item', 'transaction'])
+
+    def test_changes_pages_through_ties(self):
+        stamp = self.item.updated_at
+        for amount in range(4):
+            Item.objects.create(amount=amount)
+        Item.objects.update(updated_at=stamp)
+
+        seen = []
+        data = {'cursor': None, 'has_more': True}
+        while data['has_more']:
+            params = {'limit': 2}
+            if data['cursor']:
+                params['since'] = data['cursor']
+            data = self.get_changes(**params)
+            seen.extend(change['data']['id'] for change in data['results'])
+        self.assertEqual(seen, sorted(str(pk) for pk in Item.objects.values_list('id', flat=True)))
+
+    def test_changes_hold_back_recent_rows(self):
+        with override_settings(CHANGE_FEED_LAG=60):
+            self.assertEqual(self.get_changes()['results'], [])
+
+    def test_changes_invalid_cursor(self):
+        response = self.client.get(reverse('changes'), {'since': 'nope'}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+
+@mock.patch.object(SlidingWindowThrottle, 'THROTTLE_RATES', {
+    'reads': '5/minute', 'actions': '2/minute', 'actions_global': '100/minute'})
+class ThrottleTestCase(APIBaseTestCase):
+
+    def test_actions_throttled(self):
+        self.new_transaction()
+        self.call_item_endpoint('item-move')
+        self.call_item_endpoint('item-move')
+
+        response = self.client.post(reverse('item-move', args=[self.item.id]), format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', response)
+
+        # reads have their own budget
+        response = self.client.get(reverse('item-detail', args=[self.item.id]), format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+
+    def test_reads_throttled(self):
+        url = reverse('item-list')
+        for _ in range(5):
+            self.assertEqual(self.client.get(url, format='json').status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url, format='json').status_code, rest_status.HTTP_429_TOO_MANY_REQUESTS)
+
+    @override_settings(ADMISSION_CONTROL={'MAX_CONCURRENT_WRITES': 1, 'RETRY_AFTER': 3, 'TIMEOUT': 60})
+    def test_writes_shed_when_saturated(self):
+        in_flight = WriteAdmission()
+        self.assertTrue(in_flight.acquire())
+
+        response = self.client.post(reverse('item-list'), {'amount': 10}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '3')
+
+        in_flight.release()
+        response = self.client.post(reverse('item-list'), {'amount': 10}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_201_CREATED)
+
+    @override_settings(ADMISSION_CONTROL={'MAX_CONCURRENT_WRITES': 2, 'RETRY_AFTER': 1, 'TIMEOUT': 60})
+    def test_leaked_admission_is_forgotten(self):
+        started = time.time()
+        first, second = WriteAdmission(), WriteAdmission()
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+        self.assertFalse(WriteAdmission().acquire())
+
+        # the worker that acquired first died without releasing, a period later its write still counts
+        second.release()
+        with mock.patch('time.time', return_value=started + 60):
+            self.assertTrue(second.acquire())
+            self.assertFalse(WriteAdmission().acquire())
+            second.release()
+        with mock.patch('time.time', return_value=started + 120):
+            self.assertTrue(WriteAdmission().acquire())
+            self.assertTrue(WriteAdmission().acquire())
+
+    def test_window_slides(self):
+        throttle = SlidingWindowThrottle.__new__(SlidingWindowThrottle)
+        throttle.cache, throttle.rate, throttle.num_requests, throttle.duration = caches[THROTTLE_CACHE], '4/m', 4, 60
+        throttle.get_cache_key = lambda request, view: 'throttle_test'
+        start = 600 * 60
+
+        def allowed(at):
+            throttle.timer = lambda: start + at
+            return throttle.allow_request(None, None)
+
+        self.assertEqual([allowed(50) for _ in range(5)], [True] * 4 + [False])
+        self.assertAlmostEqual(throttle.wait(), 25)
+        # a quarter into the next window, three quarters of the previous four requests still count
+        self.assertEqual([allowed(75) for _ in range(2)], [True, False])
+        # rejected requests are not counted
+        self.assertEqual(caches[THROTTLE_CACHE].get('throttle_test:601'), 1)
+        self.assertEqual([allowed(105) for _ in range(3)], [True, True, False])
+
+    def test_throttles_skip_database(self):
+        self.new_transaction()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('item-detail', args=[self.item.id]), format='json',
+                                       HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertFalse([q for q in queries.captured_queries if not q['sql'].startswith('SELECT')])
+
+
+class ConditionalGetTestCase(APIBaseTestCase):
+
+    def test_item_not_modified(self):
+        url = reverse('item-detail', args=[self.item.id])
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        etag = response['ETag']
+
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get(url, format='json', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+        self.new_transaction(status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE)
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_missing(self):
+        for name in ('item-detail', 'transaction-detail'):
+            response = self.client.get(reverse(name, args=['not-a-uuid']), format='json')
+            self.assertEqual(response.status_code, rest_status.HTTP_404_NOT_FOUND)
+            response = self.client.get(reverse(name, args=[uuid7()]), format='json', HTTP_IF_NONE_MATCH='*')
+            self.assertEqual(response.status_code, rest_status.HTTP_404_NOT_FOUND)
+
+    def test_list_not_modified(self):
+        url = reverse('transaction-list')
+        self.new_transaction()
+        etag = self.client.get(url, format='json')['ETag']
+
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+        # a deleted row changes the list
+        Transaction.objects.all().delete()
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+
+    def test_item_missing(self):
+        response = self.client.get(reverse('item-detail', args=[Transaction().id]), format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_404_NOT_FOUND)
+
+
+class TimeOrderedIdTestCase(APIBaseTestCase):
+
+    def test_uuid7(self):
+        ids = []
+        for _ in range(3):
+            ids.append(uuid7())
+            time.sleep(0.002)
+        self.assertEqual([pk.version for pk in ids], [7, 7, 7])
+        self.assertEqual([pk.variant for pk in ids], [uuid.RFC_4122] * 3)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_generate_id(self):
+        self.assertEqual(Item.objects.create(amount=1).id.version, 7)
+        with override_settings(TIME_ORDERED_IDS=False):
+            self.assertEqual(generate_id().version, 4)
+
+
+class FilterTestCase(APIBaseTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Transaction(item=cls.item, status=Transaction.STATUS_ERROR, location=Transaction.LOCATION_ROUTABLE).save()
+        cls.item.refresh_from_db()
+        cls.small = Item.objects.create(amount=10)
+        Transaction(item=cls.small, status=Transaction.STATUS_PROCESSING,
+                    location=Transaction.LOCATION_ORIGIN).save()
+        cls.small.refresh_from_db()
+
+    def get_ids(self, url, params, expected_status=rest_status.HTTP_200_OK):
+        response = self.client.get(url, params, format='json')
+        self.assertEqual(response.status_code, expected_status)
+        if expected_status == rest_status.HTTP_200_OK:
+            results = response.data['results'] if 'results' in response.data else response.data
+            return [row['id'] for row in results]
+        return response.data
+
+    def test_item_filters(self):
+        url = reverse('item-list')
+        self.assertEqual(self.get_ids(url, {'state': Item.STATE_ERROR}), [str(self.item.id)])
+        self.assertEqual(self.get_ids(url, {'amount_min': 5, 'amount_max': 100}), [str(self.small.id)])
+        self.assertEqual(self.get_ids(url, {'updated_after': self.small.updated_at.isoformat()}),
+                         [str(self.small.id)])
+        self.assertEqual(self.get_ids(url, {'state': Item.STATE_PROCESSING, 'status': Transaction.STATUS_ERROR}), [])
+        self.assertEqual(self.get_ids(url, {'amount_min': 0, 'status': Transaction.STATUS_ERROR}),
+                         [str(self.item.id)])
+
+    def test_item_filters_must_be_selective(self):
+        url = reverse('item-list')
+        with mock.patch.object(IndexedFilterBackend, 'max_scan_rows', 1):
+            # amount_min=0 selects every item, so status would still be checked for all of them
+            self.assertIn('detail', self.get_ids(url, {'amount_min': 0, 'status': Transaction.STATUS_ERROR},
+                                                 rest_status.HTTP_400_BAD_REQUEST))
+            self.assertEqual(self.get_ids(url, {'state': Item.STATE_ERROR, 'status': Transaction.STATUS_ERROR}),
+                             [str(self.item.id)])
+
+    def test_item_filters_rejected(self):
+        url = reverse('item-list')
+        self.assertIn('status', self.get_ids(url, {'status': 'lost'}, rest_status.HTTP_400_BAD_REQUEST))
+        self.assertIn('colour', self.get_ids(url, {'colour': 'red'}, rest_status.HTTP_400_BAD_REQUEST))
+        self.assertIn('amount_min', self.get_ids(url, {'amount_min': 'x'}, rest_status.HTTP_400_BAD_REQUEST))
+        # would look up the active transaction of every item
+        self.get_ids(url, {'status': Transaction.STATUS_ERROR}, rest_status.HTTP_400_BAD_REQUEST)
+
+    def test_transaction_filters(self):
+        url = reverse('transaction-list')
+        self.assertEqual(len(self.get_ids(url, {'item': self.small.id})), 1)
+        self.assertEqual(len(self.get_ids(url, {'status': Transaction.STATUS_PROCESSING,
+                                                'location': Transaction.LOCATION_ORIGIN})), 1)
+        self.get_ids(url, {'location': Transaction.LOCATION_ORIGIN}, rest_status.HTTP_400_BAD_REQUEST)
+        self.get_ids(url, {'item': 'nope'}, rest_status.HTTP_400_BAD_REQUEST)
+
+    def test_list_page(self):
+        response = self.client.get(reverse('item-list'), {'state': Item.STATE_PROCESSING, 'limit': 1}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual([row['id'] for row in response.data['results']], [str(self.small.id)])
+
+
+class HistoryTestCase(APIBaseTestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.new_transaction()
+        self.call_move_endpoint()
+        self.call_move_endpoint(expected_state=Item.STATE_RESOLVED)
+
+    def test_item_transactions(self):
+        url = reverse('item-transactions', args=[self.item.id])
+        response = self.client.get(url, {'limit': 2}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([row['status'] for row in response.data['results']],
+                         [Transaction.STATUS_COMPLETED, Transaction.STATUS_PROCESSING])
+
+        response = self.client.get(url, {'limit': 2, 'offset': 2}, format='json')
+        self.assertEqual([row['location'] for row in response.data['results']], [Transaction.LOCATION_ORIGIN])
+
+        response = self.client.get(url, {'limit': 2, 'offset': 2}, format='json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+    def test_item_transactions_missing(self):
+        response = self.client.get(reverse('item-transactions', args=[uuid7()]), format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_404_NOT_FOUND)
+
+    def test_expand_transactions(self):
+        other = Item.objects.create(amount=10)
+        Transaction(item=other, status=Transaction.STATUS_PROCESSING, location=Transaction.LOCATION_ORIGIN).save()
+
+        with CaptureQueriesContext(connection) as queries, mock.patch('api.views.ItemView.expand_limit', 2):
+            response = self.client.get(reverse('item-list'), {'expand': 'transactions'}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        histories = {row['id']: [trans['status'] for trans in row['transactions']] for row in response.data}
+        self.assertEqual(histories, {
+            str(self.item.id): [Transaction.STATUS_COMPLETED, Transaction.STATUS_PROCESSING],
+            str(other.id): [Transaction.STATUS_PROCESSING],
+        })
+        # the conditional check, the items and their transactions
+        selects = [q for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 4)
+        # numbered once per item rather than looked up per transaction
+        self.assertEqual(selects[-1]['sql'].count('ROW_NUMBER()'), 1)
+
+    def test_expand_invalid(self):
+        response = self.client.get(reverse('item-list'), {'expand': 'events'}, format='json')
+        self.assertEqual(response.status_code, rest_status.HTTP_400_BAD_REQUEST)
+
+
+class BatchTestCase(APIBaseTestCase):
+
+    def batch(self, operations, atomic=False, expected_status=rest_status.HTTP_200_OK):
+        response = self.client.post(reverse('batch'), {'atomic': atomic, 'operations': operations}, format='json')
+        self.assertEqual(response.status_code, expected_status)
+        return response.data
+
+    def test_batch_flow(self):
+        data = self.batch([
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 50}},
+            {'method': 'POST', 'path': '/api/transactions',
+             'body': {'item': '$0.id', 'status': Transaction.STATUS_PROCESSING,
+                      'location': Transaction.LOCATION_ORIGIN}},
+            {'method': 'POST', 'path': '/api/items/$0.id/move'},
+            {'method': 'POST', 'path': '/api/items/$0.id/move'},
+            {'method': 'GET', 'path': '/api/items/$0.id/transactions?limit=1'},
+        ])
+        self.assertEqual([result['status'] for result in data['results']], [201, 201, 200, 200, 200])
+        self.assertEqual(data['results'][3]['body']['state'], Item.STATE_RESOLVED)
+        self.assertEqual(data['results'][4]['body']['results'][0]['status'], Transaction.STATUS_COMPLETED)
+
+    def test_batch_atomic_rollback(self):
+        data = self.batch([
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 50}},
+            {'method': 'POST', 'path': '/api/transactions', 'body': {'item': '$0.id', 'status': 'lost'}},
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 60}},
+        ], atomic=True, expected_status=rest_status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(data['rolled_back'])
+        self.assertEqual([result['status'] for result in data['results']], [201, 400])
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_batch_not_atomic(self):
+        data = self.batch([
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 50}},
+            {'method': 'GET', 'path': '/api/nowhere'},
+            {'method': 'POST', 'path': '/api/batch', 'body': {'operations': []}},
+            {'method': 'GET', 'path': '/api/items/$9.id'},
+        ])
+        self.assertEqual([result['status'] for result in data['results']], [201, 404, 404, 400])
+        self.assertEqual(Item.objects.count(), 2)
+
+    @override_settings(ADMISSION_CONTROL={'MAX_CONCURRENT_WRITES': 1, 'RETRY_AFTER': 1, 'TIMEOUT': 60})
+    def test_batch_operation_raises(self):
+        # moving an item without transactions raises
+        operations = [
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 50}},
+            {'method': 'POST', 'path': '/api/items/$0.id/move'},
+            {'method': 'POST', 'path': '/api/items', 'body': {'amount': 60}},
+        ]
+        with self.assertLogs('api', 'ERROR'):
+            data = self.batch(operations)
+        self.assertEqual([result['status'] for result in data['results']], [201, 500, 201])
+        self.assertEqual(Item.objects.count(), 3)
+
+        with self.assertLogs('api', 'ERROR'):
+            data = self.batch(operations, atomic=True, expected_status=rest_status.HTTP_400_BAD_REQUEST)
+        self.assertTrue(data['rolled_back'])
+        self.assertEqual([result['status'] for result in data['results']], [201, 500])
+        self.assertEqual(Item.objects.count(), 3)
+        # the failed operation let go of its admission
+        self.assertTrue(WriteAdmission().acquire())
+
+    def test_batch_invalid(self):
+        self.batch([{'method': 'GET', 'path': '/admin/'}], expected_status=rest_status.HTTP_400_BAD_REQUEST)
+        self.batch([], expected_status=rest_status.HTTP_400_BAD_REQUEST)
+
+
+class SchemaTestCase(APIBaseTestCase):
+    urlpatterns = APIBaseTestCase.urlpatterns + [
+        path('openapi', CachedSchemaView.as_view(), name='openapi-schema'),
+        path('openapi-dynamic', get_schema_view(**SCHEMA_OPTIONS), name='openapi-dynamic'),
+    ]
+
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(OPENAPI_SCHEMA_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        CachedSchemaView.documents = None
+        self.addCleanup(setattr, CachedSchemaView, 'documents', None)
+
+    def assertSchemaMatches(self, **headers):
+        dynamic = self.client.get(reverse('openapi-dynamic'), **headers)
+        cached = self.client.get(reverse('openapi-schema'), **headers)
+        self.assertEqual(cached.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(cached['Content-Type'], dynamic['Content-Type'])
+        self.assertEqual(cached.content, dynamic.content)
+
+    def test_cached_schema_matches_dynamic(self):
+        self.assertSchemaMatches()
+        self.assertSchemaMatches(HTTP_ACCEPT='application/vnd.oai.openapi+json')
+
+    def test_generated_schema_matches_dynamic(self):
+        call_command('generate_schema', stdout=StringIO())
+        self.assertSchemaMatches()
+
+    def test_stale_schema_regenerated(self):
+        call_command('generate_schema', stdout=StringIO())
+        with open(os.path.join(self.directory, 'openapi.yaml'), 'wb') as f:
+            f.write(b'stale')
+        with mock.patch('api.schema.schema_fingerprint', return_value='changed'):
+            self.assertSchemaMatches()
+
+    def test_schema_etag_and_gzip(self):
+        url = reverse('openapi-schema')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.client.get(url).content)
+
+        gzipped_etag = response['ETag']
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzipped_etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+        # the uncompressed body is a different representation
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=gzipped_etag)
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], gzipped_etag)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+    def test_schema_gzip_refused(self):
+        response = self.client.get(reverse('openapi-schema'), HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertNotIn('Content-Encoding', response)
+
+
+@override_settings(
+    MIDDLEWARE=['django.middleware.security.SecurityMiddleware', 'django.middleware.common.CommonMiddleware',
+                'routable.middleware.AdminOnlyMiddleware'],
+    ADMIN_MIDDLEWARE_PREFIX='/admin/',
+    ADMIN_MIDDLEWARE=['django.contrib.sessions.middleware.SessionMiddleware',
+                      'django.middleware.csrf.CsrfViewMiddleware',
+                      'django.contrib.auth.middleware.AuthenticationMiddleware',
+                      'django.contrib.messages.middleware.MessageMiddleware',
+                      'django.middleware.clickjacking.XFrameOptionsMiddleware'],
+)
+class AdminOnlyMiddlewareTestCase(APIBaseTestCase):
+    urlpatterns = APIBaseTestCase.urlpatterns + [
+        path('admin/', admin.site.urls),
+    ]
+
+    def test_api_skips_admin_middleware(self):
+        response = self.client.get(reverse('item-list'))
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertNotIn('X-Frame-Options', response)
+        self.assertFalse(response.cookies)
+
+    def test_admin_runs_admin_middleware(self):
+        response = self.client.get(reverse('admin:login'))
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+        self.assertIn('csrftoken', response.cookies)
+
+        client = self.client_class(enforce_csrf_checks=True)
+        response = client.post(reverse('admin:login'), {'username': 'admin', 'password': 'admin'})
+        self.assertEqual(response.status_code, rest_status.HTTP_403_FORBIDDEN)
+
+
+class CompressionTestCase(APIBaseTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        create_items(50)
+
+    def test_large_response_is_compressed(self):
+        url = reverse('item-list')
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertTrue(response['ETag'].startswith('W/'))
+
+    def test_brotli_is_preferred(self):
+        url = reverse('item-list')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), self.client.get(url).content)
+
+    def test_not_compressed(self):
+        response = self.client.get(reverse('item-list'), HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response)
+
+        response = self.client.get(reverse('item-list'), {'limit': 1}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_accepted_encodings_by_quality(self):
+        self.assertEqual(accepted_encodings('gzip, br'), ['br', 'gzip'])
+        self.assertEqual(accepted_encodings('gzip;q=1, br;q=0.5'), ['gzip', 'br'])
+        self.assertEqual(accepted_encodings('*;q=0.5, gzip'), ['gzip', 'br'])
+        self.assertEqual(accepted_encodings('br;q=0, *'), ['gzip'])
+        self.assertEqual(accepted_encodings('identity'), [])
+
+    def test_html_is_not_compressed(self):
+        page = '<input name="csrfmiddlewaretoken" value="secret">'.ljust(2048)
+        middleware = CompressionMiddleware(lambda request: HttpResponse(page, content_type='text/html'))
+        response = middleware(RequestFactory().get('/admin/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_malformed_quality_is_ignored(self):
+        for header in ('gzip;q=.', 'gzip;q=1.0.0'):
+            response = self.client.get(reverse('item-list'), HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_streaming_response_is_compressed_in_chunks(self):
+        chunks = [b'{"results": [', *(b'{"index": %d},' % index for index in range(1000)), b'{}]}']
+        middleware = CompressionMiddleware(
+            lambda request: StreamingHttpResponse(iter(chunks), content_type='application/json'))
+        response = middleware(RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), b''.join(chunks))
+
+
+class StaticFilesTestCase(APIBaseTestCase):
+    css = b'body { margin: 0; }\n' * 100
+
+    def setUp(self) -> None:
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source = os.path.join(directory.name, 'source')
+        os.makedirs(source)
+        with open(os.path.join(source, 'app.css'), 'wb') as f:
+            f.write(self.css)
+
+        settings_override = override_settings(
+            STATIC_ROOT=os.path.join(directory.name, 'static'),
+            STATICFILES_DIRS=[source],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STATICFILES_STORAGE='routable.storage.CompressedManifestStaticFilesStorage',
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_hashed_file_is_immutable(self):
+        hashed_name = staticfiles_storage.stored_name('app.css')
+        self.assertTrue(staticfiles_storage.exists(hashed_name + '.gz'))
+
+        response = self.client.get('/static/' + hashed_name, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, rest_status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.css)
+
+    def test_unhashed_file(self):
+        response = self.client.get('/static/app.css')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(b''.join(response.streaming_content), self.css)
+
+        response = self.client.get('/static/app.css', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, rest_status.HTTP_304_NOT_MODIFIED)
+
+    def test_missing_file(self):
+        self.assertEqual(self.client.get('/static/missing.css').status_code, rest_status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/static/../settings.py').status_code, rest_status.HTTP_404_NOT_FOUND)
+
+
+class LargeDatasetTestCase(APIBaseTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.items = create_items(1200)
+        cls.long = create_items(1, history=120)[0]
+
+    def get(self, url, params=None, expected_status=rest_status.HTTP_200_OK):
+        response = self.client.get(url, params, format='json')
+        self.assertEqual(response.status_code, expected_status)
+        return response.data
+
+    def test_list_pages(self):
+        url = reverse('item-list')
+        everything = [row['id'] for row in self.get(url)]
+        self.assertEqual(len(everything), 1202)
+
+        pages = []
+        for offset in range(0, 1202, 500):
+            page = self.get(url, {'limit': 500, 'offset': offset})
+            self.assertEqual(page['count'], 1202)
+            pages.extend(row['id'] for row in page['results'])
+        self.assertEqual(pages, everything)
+
+    def test_limit_is_capped(self):
+        page = self.get(reverse('item-list'), {'limit': 5000})
+        self.assertEqual(len(page['results']), 1000)
+        self.assertIsNotNone(page['next'])
+
+    def test_long_history_pages(self):
+        url = reverse('item-transactions', args=[self.long.id])
+        history = []
+        page = self.get(url)
+        while True:
+            self.assertEqual(page['count'], 120)
+            history.extend(page['results'])
+            if not page['next']:
+                break
+            page = self.get(page['next'])
+
+        self.assertEqual(len(history), 120)
+        self.assertEqual(history[0]['status'], Transaction.STATUS_PROCESSING)
+        stamps = [row['updated_at'] for row in history]
+        self.assertEqual(stamps, sorted(stamps, reverse=True))
+
+    def test_expand_long_history(self):
+        rows = self.get(reverse('item-list'), {
+            'expand': 'transactions',
+            'created_before': (self.long.created_at + timedelta(seconds=1)).isoformat(),
+        })
+        self.assertEqual([row['id'] for row in rows], [str(self.long.id)])
+        self.assertEqual(len(rows[0]['transactions']), 10)
+        self.assertEqual(rows[0]['transactions'][0]['status'], Transaction.STATUS_PROCESSING)
+
+
+class BulkSettleTestCase(APIBaseTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.items = create_items(500, history=3)
+
+    def test_settle_all(self):
+        call_command('settle', '--processes=1', '--chunk-size=100', stdout=StringIO())
+        self.assertEqual(Item.objects.filter(state=Item.STATE_RESOLVED).count(), 500)
+        self.assertEqual(Transaction.objects.filter(item__in=self.items).count(), 2500)
+        self.assertEqual(Transaction.objects.filter(item__in=self.items, status=Transaction.STATUS_COMPLETED).count(),
+                         500)
+
+
+class CodedChoicesMigrationTestCase(DatabaseTransactionTestCase):
+    before = [('api', '0004_time_ordered_ids')]
+    after = [('api', '0005_coded_choices_swap')]
+    encode = importlib.import_module('api.migrations.0005_coded_choices_encode')
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_round_trip(self):
+        apps = self.migrate(self.before)
+        Item = apps.get_model('api', 'Item')
+        items = [Item.objects.create(amount=10, state=state) for state in ('error', 'resolved', 'processing')]
+        trans = apps.get_model('api', 'Transaction').objects.create(item=items[0], status='fixing',
+                                                                    location='routable')
+
+        # several batches
+        with mock.patch.object(self.encode, 'BATCH_SIZE', 2):
+            apps = self.migrate([('api', '0005_coded_choices_encode')])
+        # written by the running application between the batches and the swap
+        apps.get_model('api', 'Item').objects.create(amount=20, state='correcting')
+        apps.get_model('api', 'Item').objects.filter(pk=items[0].pk).update(state='resolved')
+        self.migrate(self.after)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT state FROM api_item')
+            self.assertEqual(sorted(row[0] for row in cursor.fetchall()), [1, 2, 4, 4])
+            cursor.execute('SELECT status, location FROM api_transaction')
+            self.assertEqual(cursor.fetchall(), [(6, 2)])
+
+        with mock.patch.object(self.encode, 'BATCH_SIZE', 2):
+            apps = self.migrate(self.before)
+        trans = apps.get_model('api', 'Transaction').objects.select_related('item').get(pk=trans.pk)
+        self.assertEqual((trans.item.state, trans.status, trans.location), ('resolved', 'fixing', 'routable'))
+        self.assertEqual(sorted(apps.get_model('api', 'Item').objects.values_list('state', flat=True)),
+                         ['correcting', 'processing', 'resolved', 'resolved'])
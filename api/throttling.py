@@ -0,0 +1,165 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import SimpleRateThrottle
+
+THROTTLE_CACHE = 'throttle'
+
+
+def increment(cache, key, timeout):
+    """
+    Add one to a counter, creating it if it is missing. Only `add` and `incr` are used, which a shared cache
+    (e.g. Redis) runs atomically.
+
+    :param cache: The cache
+    :param key: The key of the counter
+    :param timeout: Seconds the counter lives after it is created
+    :return: The new count
+    """
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired between add and incr
+        cache.add(key, 1, timeout)
+        return 1
+
+
+def decrement(cache, key):
+    try:
+        cache.decr(key)
+    except ValueError:
+        # expired, the count has already been reset
+        pass
+
+
+class SlidingWindowThrottle(SimpleRateThrottle):
+    """
+    Throttle with a sliding window counter per client, the form of a token bucket that a cache can keep with
+    atomic increments. Requests are counted per `duration` long window, and a request is allowed while the count
+    of the current window, plus that of the previous one weighted by how much of it the last `duration` seconds
+    still cover, stays within `num_requests`. A client may burst up to `num_requests` but not exceed the rate
+    over time.
+
+    Counters live in the `throttle` cache, which must be shared (e.g. Redis) for the limits to hold across
+    processes and hosts. Nothing is written to the database.
+    """
+
+    def __init__(self):
+        self.cache = caches[THROTTLE_CACHE]
+        self.wait_time = None
+        super().__init__()
+
+    def applies(self, request, view):
+        return True
+
+    def get_cache_key(self, request, view):
+        if not self.applies(request, view):
+            return None
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        window, elapsed = divmod(self.now, self.duration)
+        key = '{}:{:.0f}'.format(self.key, window)
+        # a window's count is still read during the next window
+        count = increment(self.cache, key, self.duration * 2)
+        previous = self.cache.get('{}:{:.0f}'.format(self.key, window - 1), 0)
+        overlap = 1 - elapsed / self.duration
+        if previous * overlap + count <= self.num_requests:
+            return True
+
+        # a rejected request does not count against the client
+        decrement(self.cache, key)
+        self.wait_time = self.get_wait(previous, count - 1, overlap)
+        return False
+
+    def get_wait(self, previous, count, overlap):
+        """
+        :return: Seconds until the window has slid far enough to allow one more request
+        """
+        room = self.num_requests - 1
+        if count > room:
+            # wait for the current window to become the previous one, and for enough of it to slide out
+            return (overlap + 1 - room / count) * self.duration
+        return (overlap - (room - count) / previous) * self.duration
+
+    def wait(self):
+        return self.wait_time
+
+
+class ReadRateThrottle(SlidingWindowThrottle):
+    scope = 'reads'
+
+    def applies(self, request, view):
+        return request.method in SAFE_METHODS
+
+
+class ActionRateThrottle(SlidingWindowThrottle):
+    """
+    Throttle the state changing actions (`move`, `error`, `fix`) of a client
+    """
+    scope = 'actions'
+
+    def applies(self, request, view):
+        return getattr(view, 'action', None) in getattr(view, 'throttled_actions', ())
+
+
+class GlobalActionRateThrottle(ActionRateThrottle):
+    """
+    Throttle the state changing actions of all clients together
+    """
+    scope = 'actions_global'
+
+    def get_cache_key(self, request, view):
+        if not self.applies(request, view):
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': 'all'}
+
+
+class WriteAdmission:
+    """
+    Count the writes in flight, so that once `MAX_CONCURRENT_WRITES` are running new ones are turned away
+    instead of queueing on the database. A write is counted in the counter of the `TIMEOUT` long period it
+    started in, and the counters of the current and the previous period are added up, so a count leaked by a
+    worker that died mid-request is forgotten after two periods at most.
+    """
+    key_format = 'admission_writes:%d'
+
+    def __init__(self):
+        self.cache = caches[THROTTLE_CACHE]
+        self.config = settings.ADMISSION_CONTROL
+        self.key = None
+
+    @property
+    def retry_after(self):
+        return self.config['RETRY_AFTER']
+
+    def acquire(self):
+        timeout = self.config['TIMEOUT']
+        period = int(time.time() // timeout)
+        key = self.key_format % period
+        in_flight = increment(self.cache, key, timeout * 2) + self.cache.get(self.key_format % (period - 1), 0)
+        if in_flight > self.config['MAX_CONCURRENT_WRITES']:
+            decrement(self.cache, key)
+            return False
+        self.key = key
+        return True
+
+    def release(self):
+        if self.key is not None:
+            decrement(self.cache, self.key)
+            self.key = None
@@ -1,7 +1,7 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from api.views import ItemView, TransactionView
+from api.views import BatchView, ChangeFeedView, ItemView, TransactionView
 
 # Create a router and register our viewsets with it.
 router = DefaultRouter(trailing_slash=False)
@@ -10,5 +10,7 @@ router.register(r'transactions', TransactionView, 'transaction')
 
 
 urlpatterns = [
+    path('batch', BatchView.as_view(), name='batch'),
+    path('changes', ChangeFeedView.as_view(), name='changes'),
     path('', include(router.urls)),
 ]
@@ -1,9 +1,39 @@
 # ViewSets define the view behavior.
+import base64
+import binascii
+import hashlib
+import heapq
+import json
+import logging
+import re
+import uuid
+from contextlib import nullcontext
+from datetime import timedelta
+from io import BytesIO
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import transaction
+from django.db.models import Count, Max, OuterRef, Prefetch, Q, Subquery, prefetch_related_objects
+from django.urls import Resolver404, resolve
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from django.utils.timezone import now
 from rest_framework import serializers, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import Throttled, ValidationError
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from api.filters import Filter, parse_choice, parse_decimal, parse_timestamp, parse_uuid
+from api.models import Event, Item, Transaction
+from api.pagination import HistoryPagination
+from api.throttling import WriteAdmission
 
-from api.models import Item, Transaction
+logger = logging.getLogger(__name__)
 
 
 class ItemSerializer(serializers.HyperlinkedModelSerializer):
@@ -24,10 +54,195 @@ class TransactionSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 
-class ItemView(viewsets.ModelViewSet):
+class ItemHistorySerializer(ItemSerializer):
+    transactions = TransactionSerializer(many=True, read_only=True, source='recent_transactions')
+
+    class Meta(ItemSerializer.Meta):
+        fields = ItemSerializer.Meta.fields + ['transactions']
+
+
+class EventSerializer(serializers.ModelSerializer):
+    item = serializers.PrimaryKeyRelatedField(read_only=True)
+    transaction = serializers.PrimaryKeyRelatedField(read_only=True)
+
+    class Meta:
+        model = Event
+        fields = ['id', 'created_at', 'item', 'transaction', 'from_state', 'to_state']
+        read_only_fields = fields
+
+
+class AdmissionControlMixin:
+    """
+    Turn writes away with a 429 and a `Retry-After` header while too many are in flight, rather than letting
+    them pile up on the database locks.
+    """
+    admission = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method not in SAFE_METHODS:
+            self.admission = WriteAdmission()
+            if not self.admission.acquire():
+                raise Throttled(wait=self.admission.retry_after)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # also when the view raised past the exception handler
+            if self.admission:
+                self.admission.release()
+
+
+class ConditionalGetMixin:
+    """
+    Add `ETag` and `Last-Modified` headers to `retrieve` and `list`, and answer `If-None-Match` and
+    `If-Modified-Since` with a 304 before anything is serialized. The validators come from `updated_at`: the
+    row's own for a detail, and for a list the latest with the row count, from a single aggregate query, so a
+    deleted row changes the list's ETag too.
+    """
+    etag = None
+    last_modified = None
+
+    def get_conditional_querysets(self, queryset):
+        """
+        The querysets whose changes change the response. Override to add related rows the response embeds.
+        :param queryset: The filtered queryset of the view
+        :return: list of QuerySet
+        """
+        return [queryset]
+
+    def get_conditional_response(self, request, queryset):
+        """
+        Compute the validators of the response, and return a 304 (or 412) response if the client's copy is still
+        current.
+        :param request: The Request object
+        :param queryset: The filtered queryset of the view
+        :return: HttpResponse or None
+        """
+        fingerprint = [request.query_params.urlencode()]
+        last_modified = None
+        for conditional_queryset in self.get_conditional_querysets(queryset):
+            values = conditional_queryset.order_by().aggregate(last_modified=Max('updated_at'), count=Count('pk'))
+            fingerprint.append('{last_modified}:{count}'.format(**values))
+            if values['last_modified'] and (last_modified is None or values['last_modified'] > last_modified):
+                last_modified = values['last_modified']
+        return self.check_validators(request, fingerprint, last_modified)
+
+    def check_validators(self, request, fingerprint, last_modified):
+        """
+        Set the validators of the response, and return a 304 (or 412) response if they match the client's.
+        :param request: The Request object
+        :param fingerprint: list of strings that change whenever the response does
+        :param last_modified: The datetime the response last changed, or None
+        :return: HttpResponse or None
+        """
+        self.etag = quote_etag(hashlib.md5('|'.join(fingerprint).encode()).hexdigest())
+        self.last_modified = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        return self.set_validators(response) if response is not None else None
+
+    def set_validators(self, response):
+        if self.etag and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = self.etag
+            if self.last_modified:
+                response['Last-Modified'] = http_date(self.last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        # get_object answers a malformed or unknown id with a 404, before any precondition is evaluated
+        instance = self.get_object()
+        fingerprint = [request.query_params.urlencode(), '{}:1'.format(instance.updated_at)]
+        return self.check_validators(request, fingerprint, instance.updated_at) or \
+            self.set_validators(Response(self.get_serializer(instance).data))
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.get_conditional_response(request, queryset) or \
+            self.set_validators(super().list(request, *args, **kwargs))
+
+
+def active_transaction(field):
+    latest = Transaction.objects.filter(item=OuterRef('pk')).order_by('-updated_at')
+    return Subquery(latest.values(field)[:1])
+
+
+class ItemView(AdmissionControlMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     lookup_field = 'id'
-    queryset = Item.objects.all()
+    queryset = Item.objects.order_by('-updated_at', '-id')
     serializer_class = ItemSerializer
+    throttled_actions = ('move', 'error', 'fix')
+    filters = {
+        'state': Filter('state', parse_choice(Item.STATE_CHOICES)),
+        'amount_min': Filter('amount__gte', parse_decimal),
+        'amount_max': Filter('amount__lte', parse_decimal),
+        'created_after': Filter('created_at__gte', parse_timestamp),
+        'created_before': Filter('created_at__lt', parse_timestamp),
+        'updated_after': Filter('updated_at__gte', parse_timestamp),
+        'updated_before': Filter('updated_at__lt', parse_timestamp),
+        # looked up per item, so they have to narrow down the items of an indexed filter
+        'status': Filter('active_status', parse_choice(Transaction.STATUS_CHOICES), indexed=False,
+                         annotations={'active_status': active_transaction('status')}),
+        'location': Filter('active_location', parse_choice(Transaction.LOCATION_CHOICES), indexed=False,
+                           annotations={'active_location': active_transaction('location')}),
+    }
+    # transactions embedded per item with ?expand=transactions
+    expand_limit = 10
+
+    @property
+    def expand_transactions(self):
+        if self.request is None:
+            return False
+        expand = self.request.query_params.get('expand')
+        if expand not in (None, 'transactions'):
+            raise ValidationError({'expand': 'Only transactions can be expanded'})
+        return self.action == 'list' and expand == 'transactions'
+
+    def get_serializer(self, *args, **kwargs):
+        if self.expand_transactions and kwargs.get('many'):
+            items = list(args[0])
+            self.prefetch_recent_transactions(items)
+            args = (items,) + args[1:]
+        return super().get_serializer(*args, **kwargs)
+
+    def prefetch_recent_transactions(self, items):
+        """
+        Set `recent_transactions` on each item to its latest `expand_limit` transactions, in one query.
+        :param items: list of Item
+        """
+        recent = Transaction.get_latest_transactions([item.id for item in items], self.expand_limit)
+        prefetch_related_objects(items, Prefetch(
+            'transaction_set', queryset=recent.order_by('-updated_at', '-id'), to_attr='recent_transactions'))
+
+    def get_serializer_class(self):
+        if self.expand_transactions:
+            return ItemHistorySerializer
+        return super().get_serializer_class()
+
+    def get_conditional_querysets(self, queryset):
+        querysets = super().get_conditional_querysets(queryset)
+        if self.expand_transactions:
+            querysets.append(Transaction.objects.filter(item__in=queryset.values('id')))
+        return querysets
+
+    @action(methods=['get'], detail=True, pagination_class=HistoryPagination)
+    def transactions(self, request, *args, **kwargs):
+        """
+        List the transactions of the item, newest first, a page at a time.
+        :param request: The Request object
+        :param args: Arguments
+        :param kwargs: Key word arguments
+        :return: Response
+        """
+        item = self.get_object()
+        queryset = Transaction.objects.filter(item=item).order_by('-updated_at', '-id')
+        response = self.get_conditional_response(request, queryset)
+        if response is not None:
+            return response
+
+        page = self.paginate_queryset(queryset)
+        serializer = TransactionSerializer(page, many=True)
+        return self.set_validators(self.get_paginated_response(serializer.data))
 
     @action(methods=['post'], detail=True)
     def move(self, request, *args, **kwargs):
@@ -96,7 +311,208 @@ class ItemView(viewsets.ModelViewSet):
             }, status=status.HTTP_400_BAD_REQUEST)
 
 
-class TransactionView(viewsets.ModelViewSet):
+class TransactionView(AdmissionControlMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     lookup_field = u'id'
-    queryset = Transaction.objects.all()
+    queryset = Transaction.objects.order_by('-updated_at', '-id')
     serializer_class = TransactionSerializer
+    filters = {
+        'item': Filter('item_id', parse_uuid),
+        'status': Filter('status', parse_choice(Transaction.STATUS_CHOICES)),
+        # only the second column of the (status, location) index
+        'location': Filter('location', parse_choice(Transaction.LOCATION_CHOICES), indexed=False),
+        'created_after': Filter('created_at__gte', parse_timestamp),
+        'created_before': Filter('created_at__lt', parse_timestamp),
+        'updated_after': Filter('updated_at__gte', parse_timestamp),
+        'updated_before': Filter('updated_at__lt', parse_timestamp),
+    }
+
+
+class ChangeFeedView(APIView):
+    """
+    Items and transactions modified after a cursor, oldest first, so clients can sync incrementally.
+
+    The cursor is the `(updated_at, id)` of the last change returned, which breaks ties between rows saved in the
+    same microsecond. Rows younger than `CHANGE_FEED_LAG` seconds are held back: a row is stamped before its
+    database transaction commits, and app servers' clocks may drift, so a recent row could still be followed
+    by an older stamp. Holding them back keeps the cursor from moving past a change that is not yet visible.
+    """
+    page_size = 100
+    max_page_size = 1000
+    feeds = (
+        ('item', Item.objects.all(), ItemSerializer),
+        ('transaction', Transaction.objects.all(), TransactionSerializer),
+    )
+
+    @staticmethod
+    def encode_cursor(updated_at, pk):
+        value = '{}|{}'.format(updated_at.isoformat(), pk.hex)
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            updated_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            updated_at = parse_datetime(updated_at)
+            pk = uuid.UUID(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            updated_at = None
+        if updated_at is None:
+            raise ValidationError({'since': 'Invalid cursor'})
+        return updated_at, pk
+
+    def get_page_size(self, request):
+        try:
+            return max(1, min(int(request.query_params.get('limit', self.page_size)), self.max_page_size))
+        except ValueError:
+            raise ValidationError({'limit': 'A valid integer is required'})
+
+    def get(self, request, *args, **kwargs):
+        """
+        Return a page of changes after the `since` cursor, or from the beginning without one.
+        :param request: The Request object
+        :param args: Arguments
+        :param kwargs: Key word arguments
+        :return: Response
+        """
+        since = request.query_params.get('since')
+        limit = self.get_page_size(request)
+        horizon = now() - timedelta(seconds=settings.CHANGE_FEED_LAG)
+
+        changes = []
+        for name, queryset, serializer_class in self.feeds:
+            queryset = queryset.filter(updated_at__lte=horizon)
+            if since:
+                updated_at, pk = self.decode_cursor(since)
+                queryset = queryset.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=pk))
+            rows = queryset.order_by('updated_at', 'id')[:limit + 1]
+            changes.append([(row.updated_at, row.id, name, row, serializer_class) for row in rows])
+
+        merged = list(heapq.merge(*changes, key=lambda change: change[:2]))
+        page = merged[:limit]
+        if page:
+            since = self.encode_cursor(page[-1][0], page[-1][1])
+
+        return Response({
+            'results': [{'type': name, 'data': serializer_class(row).data} for _, _, name, row, serializer_class in page],
+            'cursor': since,
+            'has_more': len(merged) > limit,
+        })
+
+
+class BatchOperationSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(choices=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+    path = serializers.RegexField(r'^/api/', help_text='Path of the operation, e.g. /api/items/$0.id/move')
+    body = serializers.JSONField(required=False)
+
+
+class BatchSerializer(serializers.Serializer):
+    atomic = serializers.BooleanField(default=False, help_text='Run all operations in one database transaction')
+    operations = serializers.ListField(child=BatchOperationSerializer(), min_length=1, max_length=50)
+
+
+class BatchView(APIView):
+    """
+    Run an ordered list of operations against the API in one request. `$<index>.<field>` in a path or body is
+    replaced with that field of an earlier operation's result, e.g. `/api/items/$0.id/move`. An operation that
+    raises gets a 500 result. With `atomic` the operations share one database transaction, and the first failure
+    rolls them all back and skips the rest.
+    """
+    reference = re.compile(r'\$(\d+)\.(\w+)')
+    # request headers that belong to the batch itself, not to its operations
+    batch_headers = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE')
+
+    def substitute(self, value, results):
+        """
+        Replace the references to earlier results in a path or body.
+        :param value: The path or body
+        :param results: The results so far
+        :return: The value with the references replaced
+        """
+        if isinstance(value, dict):
+            return {key: self.substitute(item, results) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.substitute(item, results) for item in value]
+        if not isinstance(value, str):
+            return value
+
+        def replace(match):
+            index, field = int(match.group(1)), match.group(2)
+            if index >= len(results) or not isinstance(results[index]['body'], dict) or \
+                    field not in results[index]['body']:
+                raise ValueError('Unresolved reference {}'.format(match.group(0)))
+            return str(results[index]['body'][field])
+        return self.reference.sub(replace, value)
+
+    def build_request(self, request, method, path, body):
+        """
+        Build the request of an operation from the batch request, keeping its client and authentication.
+        """
+        url = urlsplit(path)
+        data = json.dumps(body).encode() if body is not None else b''
+        environ = {key: value for key, value in request.META.items() if key not in self.batch_headers}
+        environ.update({
+            'REQUEST_METHOD': method,
+            'PATH_INFO': url.path,
+            'QUERY_STRING': url.query,
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(data)),
+            'wsgi.input': BytesIO(data),
+        })
+        operation_request = WSGIRequest(environ)
+        for attr in ('user', 'session'):
+            if hasattr(request._request, attr):
+                setattr(operation_request, attr, getattr(request._request, attr))
+        # the batch request passed the CSRF check already
+        operation_request._dont_enforce_csrf_checks = True
+        return operation_request
+
+    def run_operation(self, request, operation, results):
+        """
+        Run one operation through the view its path resolves to.
+        :return: dict with the status code and body of the response
+        """
+        try:
+            path = self.substitute(operation['path'], results)
+            body = self.substitute(operation.get('body'), results)
+        except ValueError as e:
+            return {'status': status.HTTP_400_BAD_REQUEST, 'body': {'status': 'error', 'details': str(e)}}
+
+        try:
+            match = resolve(urlsplit(path).path)
+        except Resolver404:
+            match = None
+        if match is None or getattr(match.func, 'view_class', None) is BatchView:
+            return {'status': status.HTTP_404_NOT_FOUND, 'body': {'status': 'error', 'details': 'Not found'}}
+
+        try:
+            response = match.func(self.build_request(request, operation['method'], path, body), *match.args,
+                                  **match.kwargs)
+        except Exception:
+            # the operations before it may have committed, so the client still gets the result of each
+            logger.exception('Batch operation %s %s failed', operation['method'], path)
+            return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    'body': {'status': 'error', 'details': 'Internal server error'}}
+        return {'status': response.status_code, 'body': getattr(response, 'data', None)}
+
+    def post(self, request, *args, **kwargs):
+        """
+        Run the operations in order and return the result of each.
+        :param request: The Request object
+        :param args: Arguments
+        :param kwargs: Key word arguments
+        :return: Response
+        """
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        atomic = serializer.validated_data['atomic']
+
+        results = []
+        with transaction.atomic() if atomic else nullcontext():
+            for operation in serializer.validated_data['operations']:
+                result = self.run_operation(request, operation, results)
+                results.append(result)
+                if atomic and result['status'] >= status.HTTP_400_BAD_REQUEST:
+                    transaction.set_rollback(True)
+                    return Response({'results': results, 'rolled_back': True},
+                                    status=status.HTTP_400_BAD_REQUEST)
+        return Response({'results': results})
@@ -0,0 +1,25 @@
+# Gunicorn settings, see https://docs.gunicorn.org/en/stable/settings.html
+import multiprocessing
+import os
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Load Django in the master, so every worker forks with it already set up
+preload_app = True
+
+
+def when_ready(server):
+    # Import every view and render the OpenAPI schema once, before the workers fork
+    from django.urls import get_resolver
+    from api.schema import CachedSchemaView
+
+    get_resolver().reverse_dict
+    CachedSchemaView.get_documents()
+
+
+def pre_fork(server, worker):
+    # Database connections opened while loading must not be shared by the workers
+    from django.db import connections
+
+    connections.close_all()
@@ -0,0 +1,82 @@
+import gzip
+import re
+
+import brotli
+from django.utils.text import compress_sequence
+
+# file suffix of each supported content coding, most preferred first
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# text formats worth compressing, images and fonts other than SVG are compressed already
+COMPRESSIBLE_TYPES = re.compile(r'^(text/|application/(json|javascript|xml)|application/[^;]*\+(json|xml)|'
+                                r'application/vnd\.oai\.openapi|image/svg\+xml)')
+
+# the API payloads compressed on the fly. HTML is left out: compressing pages that carry a CSRF token next to
+# reflected input would expose the token to BREACH.
+API_TYPES = re.compile(r'^(application/json|application/[^;]*\+json|application/vnd\.oai\.openapi)')
+
+
+def parse_quality(params):
+    """
+    Parse the q-value of an `Accept-Encoding` element, treating a malformed one like a missing one.
+
+    :param params: The parameters after the coding, e.g. ';q=0.5'
+    :return: float, 1 if there is no valid q-value
+    """
+    quality = re.search(r'q=([0-9.]+)', params)
+    try:
+        return float(quality.group(1)) if quality else 1
+    except ValueError:
+        return 1
+
+
+def accepted_encodings(header):
+    """
+    Parse an `Accept-Encoding` header.
+
+    :param header: The header value
+    :return: list of the supported encodings the client accepts, most preferred first: by the client's q-values,
+        then in the order of ENCODINGS
+    """
+    qualities = {}
+    for part in header.lower().split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip()
+        if coding:
+            qualities[coding] = parse_quality(params)
+    # '*' stands for the encodings the header does not name
+    accepted = [(qualities.get(encoding, qualities.get('*', 0)), index, encoding)
+                for index, encoding in enumerate(ENCODINGS)]
+    return [encoding for quality, _, encoding in sorted(accepted, key=lambda a: (-a[0], a[1])) if quality > 0]
+
+
+def compress(content, encoding, level):
+    """
+    Compress bytes.
+
+    :param content: The bytes
+    :param encoding: 'br' or 'gzip'
+    :param level: Brotli quality (0-11) or gzip level (1-9)
+    :return: bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(content, quality=level)
+    return gzip.compress(content, compresslevel=level, mtime=0)
+
+
+def brotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in sequence:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_stream(sequence, encoding):
+    """
+    Compress an iterable of bytes chunk by chunk, so that the whole content is never held in memory.
+    """
+    if encoding == 'br':
+        return brotli_sequence(sequence, quality=5)
+    return compress_sequence(sequence)
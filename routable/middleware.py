@@ -0,0 +1,147 @@
+import mimetypes
+import os
+import posixpath
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.module_loading import import_string
+
+from routable.compression import API_TYPES, ENCODINGS, accepted_encodings, compress, compress_stream
+
+# gzip level and Brotli quality for responses, compressed on every request
+RESPONSE_LEVELS = {'br': 5, 'gzip': 6}
+
+
+class AdminOnlyMiddleware:
+    """
+    Run the middleware listed in ADMIN_MIDDLEWARE for requests to the admin only. The JSON API does not use
+    sessions, CSRF tokens, messages or frames, so its requests skip all of them.
+
+    The wrapped middleware run through `__call__`, which covers `process_request` and `process_response`. Their
+    `process_view`, `process_exception` and `process_template_response` hooks are not called; the admin views
+    apply CSRF protection themselves with `csrf_protect`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = settings.ADMIN_MIDDLEWARE_PREFIX
+        handler = get_response
+        for middleware_path in reversed(settings.ADMIN_MIDDLEWARE):
+            handler = import_string(middleware_path)(handler)
+        self.admin_handler = handler
+
+    def __call__(self, request):
+        if request.path_info.startswith(self.prefix):
+            return self.admin_handler(request)
+        return self.get_response(request)
+
+
+class CompressionMiddleware:
+    """
+    Compress JSON and OpenAPI responses of at least COMPRESSION_MIN_SIZE bytes with the encoding the client
+    prefers, Brotli or gzip. Streaming responses are compressed chunk by chunk as they are sent, whatever their
+    size. HTML, such as the admin's pages with their CSRF tokens, is never compressed, see API_TYPES.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.min_size = settings.COMPRESSION_MIN_SIZE
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.has_header('Content-Encoding') or not API_TYPES.match(response.get('Content-Type', '')):
+            return response
+        if not response.streaming and len(response.content) < self.min_size:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encodings = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if not encodings:
+            return response
+        encoding = encodings[0]
+
+        if response.streaming:
+            # the compressed size is only known once it has been sent
+            response.streaming_content = compress_stream(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            compressed = compress(response.content, encoding, RESPONSE_LEVELS[encoding])
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # the compressed body is a different representation, so a strong ETag becomes weak (RFC 7232 2.1)
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+class StaticFilesMiddleware:
+    """
+    Serve the files collected in STATIC_ROOT, picking the Brotli or gzip copy written by
+    CompressedManifestStaticFilesStorage when the client accepts it. Files with a content hash in their name
+    never change, so they are cached for a year; the other files for a minute.
+    """
+    immutable_max_age = 365 * 24 * 60 * 60
+    max_age = 60
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = settings.STATIC_URL
+        self.root = settings.STATIC_ROOT
+        self.hashed_names = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+    def __call__(self, request):
+        if self.root and request.method in ('GET', 'HEAD') and request.path_info.startswith(self.prefix):
+            response = self.serve(request, request.path_info[len(self.prefix):])
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    def find(self, name):
+        """
+        :return: the path of the file in STATIC_ROOT, or None if there is no such file
+        """
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def serve(self, request, name):
+        name = posixpath.normpath(unquote(name)).lstrip('/')
+        path = self.find(name)
+        if path is None:
+            return None
+
+        stat = os.stat(path)
+        response = get_conditional_response(request, last_modified=int(stat.st_mtime))
+        if response is None:
+            encoding = None
+            for accepted in accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+                if os.path.isfile(path + ENCODINGS[accepted]):
+                    encoding = accepted
+                    break
+
+            content_type, _ = mimetypes.guess_type(name)
+            response = FileResponse(open(path + ENCODINGS[encoding] if encoding else path, 'rb'),
+                                    content_type=content_type or 'application/octet-stream')
+            if encoding:
+                response['Content-Encoding'] = encoding
+
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if name in self.hashed_names:
+            patch_cache_control(response, public=True, max_age=self.immutable_max_age, immutable=True)
+        else:
+            patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
@@ -33,7 +33,8 @@ INSTALLED_APPS = ['django.contrib.admin', 'django.contrib.auth', 'django.contrib
                   'django.contrib.sessions', 'django.contrib.messages', 'django.contrib.staticfiles', 'rest_framework',
                   'api.apps.ApiConfig', 'django_extensions', 'django_object_actions']
 
-MIDDLEWARE = ['django.middleware.security.SecurityMiddleware', 'django.contrib.sessions.middleware.SessionMiddleware',
+MIDDLEWARE = ['django.middleware.security.SecurityMiddleware', 'routable.middleware.CompressionMiddleware',
+              'routable.middleware.StaticFilesMiddleware', 'django.contrib.sessions.middleware.SessionMiddleware',
               'django.middleware.common.CommonMiddleware', 'django.middleware.csrf.CsrfViewMiddleware',
               'django.contrib.auth.middleware.AuthenticationMiddleware',
               'django.contrib.messages.middleware.MessageMiddleware',
@@ -64,6 +65,10 @@ DATABASES = {
     }
 }
 
+# Generate time ordered (version 7) UUID primary keys, which keep inserts local in the primary key and foreign
+# key indexes. Existing random (version 4) keys are left as they are.
+TIME_ORDERED_IDS = True
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -97,6 +102,24 @@ STATIC_URL = '/static/'
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# Responses smaller than this are sent uncompressed, see routable.middleware.CompressionMiddleware
+COMPRESSION_MIN_SIZE = 1024
+
+# Written by `manage.py generate_schema`. The schema is generated on first request if it is missing or stale.
+OPENAPI_SCHEMA_DIR = os.path.join(BASE_DIR, 'openapi')
+
+# The throttle cache holds the rate limit counters and the in flight write count. It must be shared (e.g. Redis)
+# when running more than one process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'throttle',
+    },
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -139,5 +162,34 @@ REST_FRAMEWORK = {
     'DATETIME_INPUT_FORMATS': [SEMI_ISO_DATETIME_FORMAT, ISO_DATETIME_FORMAT],
     'DATE_INPUT_FORMATS': [ISO_DATE_FORMAT],
     'DEFAULT_RENDERER_CLASSES': ('rest_framework.renderers.JSONRenderer',),
+    'DEFAULT_FILTER_BACKENDS': ('api.filters.IndexedFilterBackend',),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.BoundedLimitOffsetPagination',
+    'DEFAULT_THROTTLE_CLASSES': ('api.throttling.ReadRateThrottle', 'api.throttling.ActionRateThrottle',
+                                 'api.throttling.GlobalActionRateThrottle'),
+    'DEFAULT_THROTTLE_RATES': {
+        'reads': '600/minute',
+        'actions': '60/minute',
+        'actions_global': '1200/minute',
+    },
     'UNICODE_JSON': False
 }
+
+# Webhooks: item state changes are delivered to these endpoints by `manage.py dispatch_events`
+WEBHOOKS = {
+    'ENDPOINTS': [url for url in os.environ.get('WEBHOOK_ENDPOINTS', '').split(',') if url],
+    'BATCH_SIZE': 100,
+    'TIMEOUT': 10,
+    # seconds before the first retry, doubled on every failed attempt up to MAX_BACKOFF
+    'BACKOFF': 1,
+    'MAX_BACKOFF': 300,
+}
+
+# Seconds a change must age before the change feed serves it, covering commit latency and clock skew
+CHANGE_FEED_LAG = 5
+
+# Writes to the API beyond this many in flight are rejected with a 429 and a Retry-After of RETRY_AFTER seconds
+ADMISSION_CONTROL = {
+    'MAX_CONCURRENT_WRITES': 32,
+    'RETRY_AFTER': 1,
+    'TIMEOUT': 60,
+}
@@ -0,0 +1,27 @@
+# Lean API deployment: production without the development apps, and with the session, CSRF, auth, messages
+# and clickjacking middleware running for the admin only.
+from .production import *
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'django_extensions']
+
+MIDDLEWARE = ['django.middleware.security.SecurityMiddleware', 'routable.middleware.CompressionMiddleware',
+              'routable.middleware.StaticFilesMiddleware', 'django.middleware.common.CommonMiddleware',
+              'routable.middleware.AdminOnlyMiddleware', ]
+
+ADMIN_MIDDLEWARE_PREFIX = '/admin/'
+ADMIN_MIDDLEWARE = ['django.contrib.sessions.middleware.SessionMiddleware',
+                    'django.middleware.csrf.CsrfViewMiddleware',
+                    'django.contrib.auth.middleware.AuthenticationMiddleware',
+                    'django.contrib.messages.middleware.MessageMiddleware',
+                    'django.middleware.clickjacking.XFrameOptionsMiddleware', ]
+
+# The admin checks look for these middleware in MIDDLEWARE, but AdminOnlyMiddleware runs them for the admin
+SILENCED_SYSTEM_CHECKS = ['admin.E408', 'admin.E409', 'admin.E410']
+
+TEMPLATES = [dict(TEMPLATES[0], OPTIONS=dict(TEMPLATES[0]['OPTIONS'], context_processors=[
+    processor for processor in TEMPLATES[0]['OPTIONS']['context_processors']
+    if processor != 'django.template.context_processors.debug'
+]))]
+
+# The API is token-less, so requests skip session and basic authentication
+REST_FRAMEWORK = dict(REST_FRAMEWORK, DEFAULT_AUTHENTICATION_CLASSES=())
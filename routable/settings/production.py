@@ -1,4 +1,6 @@
 # Sentry
+import os
+
 import dj_database_url
 
 from .base import *
@@ -8,6 +10,9 @@ DEBUG = False
 # If we are running on HEROKU, otherwise use a different environment variable
 DATABASES['default'] = dj_database_url.config(env='HEROKU_POSTGRESQL_URL', conn_max_age=600)
 
+# Content hashed file names with gzip and Brotli copies, served by routable.middleware.StaticFilesMiddleware
+STATICFILES_STORAGE = 'routable.storage.CompressedManifestStaticFilesStorage'
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
@@ -17,5 +22,9 @@ CACHES = {
             'MAX_ENTRIES': 1000000,
             'CULL_FREQUENCY': 2
         }
-    }
+    },
+    'throttle': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    },
 }
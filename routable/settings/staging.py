@@ -1,4 +1,6 @@
 # Sentry
+import os
+
 import dj_database_url
 
 from .base import *
@@ -11,5 +13,9 @@ DATABASES['default'] = dj_database_url.config(env='DATABASE_URL', conn_max_age=6
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-    }
+    },
+    'throttle': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    },
 }
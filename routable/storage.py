@@ -0,0 +1,41 @@
+import mimetypes
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+from routable.compression import COMPRESSIBLE_TYPES, ENCODINGS, compress
+
+# highest levels, the files are compressed once by `collectstatic`
+STATIC_LEVELS = {'br': 11, 'gzip': 9}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also writes a gzip and a Brotli copy of every text file next to it, for
+    StaticFilesMiddleware to serve without compressing on each request. A copy is only kept if it is smaller
+    than the file.
+    """
+
+    def post_process(self, *args, **kwargs):
+        yield from super().post_process(*args, **kwargs)
+        if kwargs.get('dry_run'):
+            return
+
+        names = set(self.hashed_files) | set(self.hashed_files.values())
+        for name in sorted(names):
+            yield from self.compress_file(name)
+
+    def compress_file(self, name):
+        content_type, _ = mimetypes.guess_type(name)
+        if not content_type or not COMPRESSIBLE_TYPES.match(content_type):
+            return
+
+        with self.open(name) as f:
+            content = f.read()
+        for encoding, suffix in ENCODINGS.items():
+            compressed = compress(content, encoding, STATIC_LEVELS[encoding])
+            if len(compressed) < len(content):
+                if self.exists(name + suffix):
+                    self.delete(name + suffix)
+                self._save(name + suffix, ContentFile(compressed))
+                yield name, name + suffix, True
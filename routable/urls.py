@@ -15,12 +15,12 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework.schemas import get_schema_view
+
+from api.schema import CachedSchemaView
 
 urlpatterns = [
     path('api/', include('api.urls')),
     path('admin/', admin.site.urls),
-    path('openapi', get_schema_view(title="Routable API", description="API for Routable take home project",
-                                    urlconf='api.urls', version="1.0.0"), name='openapi-schema'),
+    path('openapi', CachedSchemaView.as_view(), name='openapi-schema'),
 ]
 